@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Read and write the annotation table from eggNOG mapper, as TSV (.tsv, .tsv.gz, .tsv.zst) or Parquet.
+
+Writing Parquet needs Python 3 and pyarrow >= 3, so the TSV written by run_eggnog_mapper.py
+is converted in a separate step:
+
+    python3 eggnog_table.py --input annotations.tsv.gz --output annotations.parquet
+"""
+
+import io
+import logging
+import argparse
+
+import storage
+
+# Columns written by eggNOG mapper, used for tables without a header
+COLUMNS = [
+    "query_name", "seed_eggNOG_ortholog", "seed_ortholog_evalue", "seed_ortholog_score",
+    "predicted_gene_name", "GO_terms", "KEGG_KOs", "BiGG_reactions", "Annotation_tax_scope",
+    "OGs", "bestOG|evalue|score", "COG cat", "eggNOG annot"
+]
+# Comma-separated fields, which are read as lists
+LIST_COLUMNS = ["GO_terms", "KEGG_KOs", "BiGG_reactions", "OGs"]
+FLOAT_COLUMNS = ["seed_ortholog_evalue", "seed_ortholog_score"]
+# Fields which repeat the same few values, and are dictionary-encoded in Parquet
+DICTIONARY_COLUMNS = ["seed_eggNOG_ortholog", "predicted_gene_name", "Annotation_tax_scope", "COG cat"]
+
+# Rows in each Parquet row group
+PARQUET_BATCH_SIZE = 100000
+
+
+def is_parquet(fp):
+    return fp.endswith(".parquet")
+
+
+def split_list(value):
+    return value.split(",") if value != "" else []
+
+
+def parse_float(value):
+    return float(value) if value != "" else None
+
+
+def parse_string(value):
+    return value if value != "" else None
+
+
+def value_parser(column):
+    """Function converting a field of the TSV to the type used in Parquet (empty fields are None)."""
+    if column in LIST_COLUMNS:
+        return split_list
+    elif column in FLOAT_COLUMNS:
+        return parse_float
+    else:
+        return parse_string
+
+
+def iter_tsv(fp, columns=None):
+    """Yield the values of each row of a TSV, for all columns or only those listed.
+
+    Comment lines are skipped, along with rows which are missing any of the columns read.
+    """
+    header = None
+    ix = None
+    with storage.open_read(fp, "rt") as f:
+        for line in f:
+            # The header is the last comment before the rows
+            if line.startswith("#query_name"):
+                header = line.rstrip("\n")[1:].split("\t")
+                ix = None
+                continue
+            elif line.startswith("#"):
+                continue
+
+            if ix is None:
+                if header is None:
+                    header = COLUMNS
+                for column in columns or []:
+                    assert column in header, "No {} column in {}".format(column, fp)
+                ix = [
+                    (header.index(column), value_parser(column))
+                    for column in (columns or header)
+                ]
+                # Columns to the right of the last one needed are not split
+                max_ix = max([i for i, _ in ix])
+
+            row = line.rstrip("\n").split("\t", max_ix + 1)
+            if len(row) <= max_ix:
+                continue
+            yield tuple([parse(row[i]) for i, parse in ix])
+
+
+def iter_parquet(fp, columns=None):
+    """Yield the values of each row of a Parquet table, reading only the columns listed."""
+    import pyarrow.parquet as pq
+
+    # Parquet needs random access, so remote tables are read into memory
+    if storage.is_remote(fp):
+        source = io.BytesIO(storage.read_bytes(fp))
+    else:
+        source = fp
+
+    pf = pq.ParquetFile(source)
+    for column in columns or []:
+        assert column in pf.schema_arrow.names, "No {} column in {}".format(column, fp)
+
+    for batch in pf.iter_batches(batch_size=PARQUET_BATCH_SIZE, columns=columns):
+        for row in zip(*[column_values(batch.column(i)) for i in range(batch.num_columns)]):
+            yield row
+
+
+def column_values(array):
+    """Python values of an Arrow array, converting lists in bulk rather than one at a time."""
+    import pyarrow as pa
+
+    if not pa.types.is_list(array.type) or array.null_count > 0:
+        return array.to_pylist()
+
+    # Slice the flattened values of every list at its offsets
+    values = array.flatten().to_pylist()
+    offsets = array.offsets.to_pylist()
+    start = offsets[0]
+    return [values[i - start:j - start] for i, j in zip(offsets[:-1], offsets[1:])]
+
+
+def iter_rows(fp, columns=None):
+    """Yield the values of each row of an annotation table, in any of the supported formats.
+
+    Multi-valued fields are lists (which are empty for empty fields), and other empty fields
+    are None, in every format.
+    """
+    logging.info("Reading in " + fp)
+    if is_parquet(fp):
+        return iter_parquet(fp, columns)
+    else:
+        return iter_tsv(fp, columns)
+
+
+def parquet_type(column):
+    import pyarrow as pa
+
+    # Lists hold plain strings, which Parquet still dictionary-encodes on disk,
+    # as lists of dictionary arrays cannot be read back as a single table
+    if column in LIST_COLUMNS:
+        return pa.list_(pa.string())
+    elif column in DICTIONARY_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    elif column in FLOAT_COLUMNS:
+        return pa.float64()
+    else:
+        return pa.string()
+
+
+def rows_to_table(rows, schema):
+    """Arrow table of a batch of rows from iter_tsv."""
+    import pyarrow as pa
+
+    if len(rows) > 0:
+        columns = [list(values) for values in zip(*rows)]
+    else:
+        columns = [[] for _ in schema]
+    return pa.Table.from_arrays(
+        [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+        schema=schema
+    )
+
+
+def write_parquet(tsv_fp, parquet_fp, batch_size=PARQUET_BATCH_SIZE):
+    """Convert an annotation table from TSV to zstd-compressed Parquet, one row group at a time."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Read the header, so that the schema is known before the first row group
+    header = COLUMNS
+    with storage.open_read(tsv_fp, "rt") as f:
+        for line in f:
+            if line.startswith("#query_name"):
+                header = line.rstrip("\n")[1:].split("\t")
+            if not line.startswith("#"):
+                break
+    schema = pa.schema([(column, parquet_type(column)) for column in header])
+
+    n_rows = 0
+    with storage.open_write(parquet_fp) as f:
+        writer = pq.ParquetWriter(f, schema, compression="zstd")
+        batch = []
+        for row in iter_tsv(tsv_fp, header):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                writer.write_table(rows_to_table(batch, schema))
+                n_rows += len(batch)
+                batch = []
+        # An empty table still has its schema
+        if len(batch) > 0 or n_rows == 0:
+            writer.write_table(rows_to_table(batch, schema))
+            n_rows += len(batch)
+        writer.close()
+
+    logging.info("Wrote {:,} rows to {}".format(n_rows, parquet_fp))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    Convert an annotation table from eggNOG mapper to Parquet.
+    """)
+
+    parser.add_argument("--input",
+                        type=str,
+                        required=True,
+                        help="""Annotations from run_eggnog_mapper.py (.tsv, .tsv.gz or .tsv.zst).
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--output",
+                        type=str,
+                        required=True,
+                        help="""Location for the Parquet table (ending .parquet).
+                                (Supported: s3://, or local path).""")
+
+    args = parser.parse_args()
+
+    # Set up logging
+    logFormatter = logging.Formatter(
+        '%(asctime)s %(levelname)-8s [eggnog_table] %(message)s'
+    )
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    # Also write to STDOUT
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+
+    assert is_parquet(args.output), "Output path must end .parquet"
+    write_parquet(args.input, args.output)
@@ -5,24 +5,21 @@ import os
 import json
 import gzip
 import sqlite3
-import requests
+import tarfile
+import asyncio
+import random
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
+from itertools import islice
 import logging
-from multiprocessing import Pool
-from functools import partial
 import re
 
-# Set up logging
-logFormatter = logging.Formatter(
-    '%(asctime)s %(levelname)-8s [kegg_reaction_metadata] %(message)s'
-)
-rootLogger = logging.getLogger()
-rootLogger.setLevel(logging.INFO)
-
-# Also write to STDOUT
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-rootLogger.addHandler(consoleHandler)
+import kegg_flatfile
+import eggnog_table
+import storage
 
 
 def chunks(l, n):
@@ -30,716 +27,1892 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def iter_chunks(it, n):
+    """Like chunks, for an iterator which is only read n items at a time."""
+    it = iter(it)
+    while True:
+        chunk = list(islice(it, n))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
 def sql_safe_string(s):
     for c in ["[", "]", ":", ";", ",", "'", '"']:
         s = s.replace(c, "")
     return s
 
 
-def open_tsv(fp, skip=0):
-    if fp.endswith(".gz"):
-        f = gzip.open(fp, "rt")
-    else:
-        f = open(fp, "rt")
+def iter_query_orthologs(input_tsv, kegg_ids):
+    """Yield each (query_name, ortholog) pair in the TSV, adding the orthologs to kegg_ids."""
+    # Only the two columns which are used are read (TSV or Parquet, local or S3)
+    for query_name, kos in eggnog_table.iter_rows(input_tsv, ["query_name", "KEGG_KOs"]):
+        # Queries without any orthologs may be null in Parquet written by other tools
+        for ko in kos or []:
+            ko = ko.strip()
+            if ko == "":
+                continue
+            kegg_ids.add(ko)
+            yield query_name, ko
 
-    for ix, line in enumerate(f):
-        if ix >= skip:
-            yield(line.rstrip("\n").split("\t"))
 
-    f.close()
+def insert_query_orthologs(conn, input_tsv, batch_size=100000):
+    """Stream the queries in the TSV into the database, returning the set of orthologs."""
+    kegg_ids = set([])
+    n_rows = 0
 
+    for batch in iter_chunks(iter_query_orthologs(input_tsv, kegg_ids), batch_size):
+        conn.executemany(
+            """INSERT OR IGNORE INTO query
+            (query_id)
+            VALUES (?)
+            """,
+            [(query, ) for query in {query for query, _ in batch}]
+        )
+        conn.executemany(
+            """INSERT OR IGNORE INTO query_ko
+            (query_ix, ortholog_id)
+            SELECT query_ix, ? FROM query WHERE query_id = ?
+            """,
+            [(ko, query) for query, ko in batch]
+        )
+        conn.commit()
+        n_rows += len(batch)
 
-def fetch_kegg_api(kegg_id, data_type):
-    r = requests.get("http://rest.kegg.jp/get/{}:{}".format(data_type, kegg_id))
+    logging.info("Read {:,} query orthologs from {}".format(n_rows, input_tsv))
+    return kegg_ids
 
-    data = defaultdict(list)
 
-    line_label = None
-    for line in r.text.split("\n"):
-        if len(line[:12].rstrip(" ")) > 0:
-            line_label = line[:12].strip(" ")
-        line_value = line[12:]
+def list_input_tsvs(input_tsv, input_manifest=None):
+    """Expand the globs given for --input-tsv, along with any paths listed in a manifest."""
+    fps = []
+    for pattern in input_tsv:
+        matches = storage.list_files(pattern)
+        assert len(matches) > 0, "No files match " + pattern
+        fps.extend(matches)
 
-        data[line_label].append(line_value)
+    if input_manifest is not None:
+        with storage.open_read(input_manifest, "rt") as f:
+            for line in f:
+                line = line.strip()
+                if line != "" and not line.startswith("#"):
+                    fps.append(line)
 
-    return data
+    # Keep the first mention of each file
+    fps = list(dict.fromkeys(fps))
+    assert len(fps) > 0, "No input TSVs were provided"
+    return fps
 
 
-def get_kegg_reaction_metadata(input_tsv=None, output_db=None, threads=1, chunk_size=100):
-    """Get reaction metadata for the KEGG entries from eggNOG output, write to SQLite."""
+def ingest_shard(input_tsv, shard_db, batch_size=100000):
+    """Read one TSV into its own database, returning the set of orthologs (run in a worker)."""
+    if os.path.exists(shard_db):
+        os.remove(shard_db)
+    conn = sqlite3.connect(shard_db)
+    create_schema(conn.cursor(), bulk_load=True)
+    conn.commit()
+    kegg_ids = insert_query_orthologs(conn, input_tsv, batch_size=batch_size)
+    conn.close()
+    return kegg_ids
 
-    # Make sure the tables exist for orthology, reaction, pathway, and compound
-    conn = sqlite3.connect(output_db)
 
-    c = conn.cursor()
-    c.execute(
-        "create table if not exists ortholog(ortholog_id TEXT, name TEXT, definition TEXT);"
-    )
-    c.execute(
-        "create unique index if not exists ortholog_ix on ortholog (ortholog_id);"
-    )
-    c.execute(
-        """create table if not exists ortholog_has_reaction
-        (ortholog_id TEXT, reaction_id TEXT, UNIQUE(ortholog_id, reaction_id))
-        ;"""
-    )
-    c.execute(
-        """create table if not exists reaction
-        (reaction_id TEXT PRIMARY KEY, definition TEXT, equation TEXT, enzyme TEXT,
-        direction INT);"""
-    )
-    c.execute(
-        "create unique index if not exists reaction_ix on reaction (reaction_id);"
-    )
-    c.execute(
-        """create table if not exists reaction_compound
-        (reaction_id TEXT, compound_id TEXT, stoichiometry INT, side TEXT,
-        UNIQUE(compound_id, reaction_id))
-        ;"""
-    )
-    c.execute(
-        "create table if not exists compound(compound_id PRIMAY KEY TEXT, formula TEXT);"
-    )
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS compound_name
-            (compound_id TEXT, name TEXT, UNIQUE(compound_id, name));
-        """
-    )
-    c.execute(
-        "create unique index if not exists compound_ix on compound (compound_id);"
-    )
-    c.execute(
-        """create table if not exists query_ortholog
-        (query_id TEXT, ortholog_id TEXT, UNIQUE(ortholog_id, query_id))
-        ;"""
-    )
+def merge_databases(conn, db_paths):
+    """Combine other databases into this one with ATTACH and INSERT OR IGNORE ... SELECT."""
+    for db_path in db_paths:
+        start = time.monotonic()
+        conn.execute("ATTACH DATABASE ? AS shard;", (db_path, ))
 
-    # Pathway, modules and links tables
-    c.execute(
-        """create table if not exists pathway
-        (pathway_id TEXT PRIMARY_KEY,
-        name TEXT,
-        class TEXT,
-        description TEXT);"""
-    )
-    c.execute(
-        "create unique index if not exists pathway_ix on pathway (pathway_id);"
-    )
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS module
-        (
-            module_id TEXT PRIMARY_KEY,
-            name TEXT,
-            class TEXT
-        ); """
-    )
-    c.execute("create unique index if not exists module_ix on module (module_id);")
-    c.execute(
-        """create table if not exists module_pathway
-        (module_id TEXT, pathway_id TEXT, UNIQUE(module_id, pathway_id))
-        ;"""
-    )
-    c.execute(
-        """create table if not exists module_compound
-        (module_id TEXT, compound_id TEXT, UNIQUE(module_id, compound_id))
-        ;"""
-    )
-    c.execute(
-        """create table if not exists module_reaction
-        (module_id TEXT, reaction_id TEXT, UNIQUE(module_id, reaction_id))
-        ;"""
-    )
-    c.execute(
-        """create table if not exists pathway_compound
-        (pathway_id TEXT, compound_id TEXT, UNIQUE(pathway_id, compound_id))
-        ;"""
-    )
-    c.execute(
-        """create table if not exists pathway_reaction
-        (pathway_id TEXT, reaction_id TEXT, UNIQUE(pathway_id, reaction_id))
-        ;"""
-    )
-    conn.commit()
+        for table, columns in MIGRATE_V1:
+            conn.execute(
+                """INSERT OR IGNORE INTO main.{table} ({columns})
+                SELECT {columns} FROM shard.{table};""".format(
+                    table=table,
+                    columns=columns
+                )
+            )
 
-    # Get the set of KEGG IDs in the input TSV
-    kegg_ids = set([])
-    # and mapping of query_name to keggs
-    query_keggs = defaultdict(set)
+        # The integer keys of the queries are assigned again in this database
+        conn.execute(
+            """INSERT OR IGNORE INTO main.query (query_id)
+            SELECT query_id FROM shard.query ORDER BY query_ix;"""
+        )
+        conn.execute(
+            """INSERT OR IGNORE INTO main.query_ko (query_ix, ortholog_id)
+            SELECT main.query.query_ix, shard.query_ko.ortholog_id
+            FROM shard.query_ko
+            JOIN shard.query USING (query_ix)
+            JOIN main.query ON main.query.query_id = shard.query.query_id;"""
+        )
+        conn.commit()
+        conn.execute("DETACH DATABASE shard;")
+        logging.info("Merged {} in {:.1f}s".format(db_path, time.monotonic() - start))
 
-    f = open_tsv(input_tsv, skip=3)
 
-    header = next(f)
+# The KEGG API accepts up to 10 entries in a single `get` request
+KEGG_BATCH_SIZE = 10
+KEGG_URL = "http://rest.kegg.jp"
 
-    # Get the set of KEGG ids represented here
-    for line in f:
-        if len(line) < len(header):
-            continue
-        entry = dict(zip(header, line))
-        assert "KEGG_KOs" in entry, entry
-        assert "#query_name" in entry, entry
-        kos = entry.get("KEGG_KOs")
-        query_name = entry.get("#query_name")
-        l_ko = {ko.strip() for ko in kos.split(',') if not ko.strip() == ''}
-        kegg_ids.update(l_ko)
-        query_keggs[query_name].update(l_ko)
 
-    logging.info("There are {:,} KEGG IDs in the input TSV".format(len(kegg_ids)))
-    c.executemany(
-        """INSERT OR REPLACE INTO query_ortholog
-        (query_id, ortholog_id)
-        VALUES (?, ?)
-        """,
-        [
-            (query, q_kegg)
-            for query, q_keggs in query_keggs.items()
-            for q_kegg in q_keggs
-        ]
-    )
-    conn.commit()
+class CrawlMetrics(object):
+    """Counters and timings for each phase of a build, with a periodic progress line.
 
-    # Figure out if we have any existing KEGGS in our db
-    c.execute('select ortholog_id from ortholog;')
-    existing_orthologs = {i[0] for i in c.fetchall()}
-    logging.info("There are {:,} KEGG IDs already in the database".format(
-        len(existing_orthologs)))
+    Every method is safe to call from the writer thread as well as the event loop.
+    """
 
-    kegg_ids_needed = list(kegg_ids - existing_orthologs)
-    logging.info("There are {:,} KEGG IDs we need to download".format(
-        len(kegg_ids_needed)))
+    def __init__(self, progress_interval=10):
+        self.start = time.monotonic()
+        self.progress_interval = progress_interval
+        self.last_progress = 0
+        self.lock = threading.Lock()
+        # Counts keyed by phase and then by name, e.g. counters['fetch']['bytes']
+        self.counters = defaultdict(lambda: defaultdict(int))
+        # Seconds taken by each operation in a phase
+        self.timings = defaultdict(list)
+        # Wall time of each top-level phase of the build
+        self.phases = {}
+        self.current_phase = None
 
-    # Begin downloading from KEGG
-    kegg_pool = Pool(threads)
+    def count(self, phase, name, n=1):
+        with self.lock:
+            self.counters[phase][name] += n
 
-    reaction_ids = set()
-    logging.info("Starting download of KEGG data")
-    # The raw data by kegg_id
-    for kegg_id_chunk_i, kegg_id_chunk in enumerate(chunks(kegg_ids_needed, chunk_size)):
-        logging.info("Working on KEGG ID chunk {:,} of {:,}".format(
-            kegg_id_chunk_i + 1,
-            int(len(kegg_ids_needed) / chunk_size) + 1
-        ))
-        raw_kegg_data = kegg_pool.map(
-            partial(
-                fetch_kegg_api,
-                data_type='ko'),
-            list(kegg_id_chunk)
-            )
-        logging.info("Completed downloading base data for chunk {}".format(
-            kegg_id_chunk_i + 1,
-        ))
-        logging.info("Inserting orthologs")
-        try:
-            c.executemany(
-                """INSERT OR REPLACE INTO ORTHOLOG
-                    (ortholog_id, name, definition)
-                    VALUES (?, ?, ?);""",
-                [(
-                    sql_safe_string(kegg_id),
-                    sql_safe_string(kegg_data.get("NAME", [""])[0]),
-                    sql_safe_string(kegg_data.get("DEFINITION", [""])[0]),
-                ) for (kegg_id, kegg_data) in zip(kegg_id_chunk, raw_kegg_data)]
+    def observe(self, phase, seconds):
+        with self.lock:
+            self.timings[phase].append(seconds)
+
+    def start_phase(self, name):
+        """Start timing a phase of the build, ending the previous phase (if any)."""
+        now = time.monotonic()
+        if self.current_phase is not None:
+            phase, start = self.current_phase
+            self.phases[phase] = self.phases.get(phase, 0) + now - start
+        self.current_phase = (name, now) if name is not None else None
+
+    def histogram(self, phase):
+        """Summarize the timings of a phase with percentiles and power-of-two buckets."""
+        with self.lock:
+            timings = sorted(self.timings[phase])
+        if len(timings) == 0:
+            return None
+
+        # Number of operations taking up to 1ms, 2ms, 4ms, ...
+        buckets = defaultdict(int)
+        for seconds in timings:
+            upper = 0.001
+            while seconds > upper:
+                upper *= 2
+            buckets["<={:g}s".format(upper)] += 1
+
+        return {
+            "n": len(timings),
+            "total": sum(timings),
+            "p50": timings[int(0.5 * (len(timings) - 1))],
+            "p90": timings[int(0.9 * (len(timings) - 1))],
+            "p99": timings[int(0.99 * (len(timings) - 1))],
+            "max": timings[-1],
+            "buckets": dict(buckets),
+        }
+
+    def log_progress(self, n_done, n_remaining, force=False):
+        """Log the rate of the crawl and the time left for the entries known so far."""
+        now = time.monotonic()
+        if not force and now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+
+        elapsed = now - self.start
+        rate = n_done / elapsed if elapsed > 0 else 0
+        with self.lock:
+            fetch = dict(self.counters["fetch"])
+        logging.info(
+            "Crawled {:,} KEGG entries ({:,} remaining), {:.1f} entries/s, {:.1f} requests/s, {:,} retries, {:,.1f} MB, ETA {}".format(
+                n_done,
+                n_remaining,
+                rate,
+                fetch.get("requests", 0) / elapsed if elapsed > 0 else 0,
+                fetch.get("retries", 0),
+                fetch.get("bytes", 0) / 1e6,
+                "{:.0f}s".format(n_remaining / rate) if rate > 0 else "unknown"
             )
-            conn.commit()
-        except Exception as e:
-            logging.error("Insertion of orthologs failed with exception {}".format(e))
-            assert 1 == 0
-        # Update our reaction id set
-        ortholog_reactions = {
-            kegg_id: set(dblink[4:].split(' '))
-            for (kegg_id, kegg_data) in zip(kegg_id_chunk, raw_kegg_data)
-            for dblink in kegg_data.get("DBLINKS", []) if dblink.startswith('RN: ')
+        )
+
+    def summary(self, **settings):
+        with self.lock:
+            counters = {
+                phase: dict(counts)
+                for phase, counts in self.counters.items()
+            }
+        return {
+            "settings": settings,
+            "elapsed": time.monotonic() - self.start,
+            "phases": self.phases,
+            "counters": counters,
+            "timings": {
+                phase: self.histogram(phase)
+                for phase in list(self.timings)
+            },
         }
-        logging.info("Inserting ortholog-reaction-links")
-        for ortholog, o_rxns in ortholog_reactions.items():
-            try:
-                c.executemany(
-                    """INSERT OR REPLACE INTO ortholog_has_reaction
-                        (ortholog_id, reaction_id)
-                        VALUES (?, ?)
-                    """,
-                    [
-                        (sql_safe_string(ortholog), sql_safe_string(rxn_id))
-                        for rxn_id in o_rxns
-                    ]
+
+    def write_json(self, fp, **settings):
+        """Write the summary of the build (along with the settings used) to a JSON file."""
+        with open(fp, "wt") as f:
+            json.dump(self.summary(**settings), f, indent=4, sort_keys=True)
+        logging.info("Wrote metrics to " + fp)
+
+
+def kegg_release_number(kegg_release):
+    """Number of a KEGG release (e.g. 113.0), without the date of the daily update (e.g. '+/01-18, Jan 25')."""
+    if kegg_release is None:
+        return None
+    m = re.match(r"(\d+\.\d+)", kegg_release.strip())
+    return m.group(1) if m is not None else kegg_release
+
+
+class KeggCache(object):
+    """Raw KEGG flat-file entries saved on disk, so that they can be reused across runs.
+
+    Entries are kept for as long as the release number of KEGG is the same, across its daily updates.
+    """
+
+    def __init__(self, cache_db, ttl_days=None, kegg_release=None):
+        self.conn = sqlite3.connect(cache_db)
+        # Entries which are not in KEGG are saved with a NULL entry
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS raw_entry
+            (kegg_key TEXT PRIMARY KEY, entry TEXT, fetched_at REAL, kegg_release TEXT);"""
+        )
+        self.ttl_days = ttl_days
+        self.kegg_release = kegg_release_number(kegg_release)
+        self.hits = 0
+        self.misses = 0
+
+        # Entries saved by earlier versions with the full release string are keyed by its number
+        for stored_release, in self.conn.execute(
+            "SELECT DISTINCT kegg_release FROM raw_entry WHERE kegg_release IS NOT NULL;"
+        ).fetchall():
+            if kegg_release_number(stored_release) != stored_release:
+                self.conn.execute(
+                    "UPDATE raw_entry SET kegg_release = ? WHERE kegg_release = ?;",
+                    (kegg_release_number(stored_release), stored_release)
                 )
-            except Exception as e:
-                logging.error("Insertion of ortholog-reactions failed with exception {}".format(e))
-                assert 1 == 0
-        for rxns in ortholog_reactions.values():
-            reaction_ids.update(rxns)
-
-    # Now work on reactions
-    c.execute("select reaction_id from reaction;")
-    existing_reaction_ids = {i[0] for i in c.fetchall()}
-    c.execute("SELECT DISTINCT reaction_id FROM ortholog_has_reaction")
-    linked_reactions = {i[0] for i in c.fetchall()}
-    reaction_ids_needed = list(reaction_ids.union(linked_reactions) - existing_reaction_ids)
-    logging.info("There are {:,} reactions we need to retrieve from KEGG".format(
-        len(reaction_ids_needed))
+
+        # Entries from an earlier release of KEGG (or of an unknown release) are no longer valid
+        if self.kegg_release is not None:
+            n_stale = self.conn.execute(
+                "DELETE FROM raw_entry WHERE kegg_release IS NOT ?;",
+                (self.kegg_release, )
+            ).rowcount
+            if n_stale > 0:
+                logging.info("Removed {:,} cached entries from an earlier KEGG release".format(n_stale))
+        self.conn.commit()
+
+    def get(self, kegg_keys):
+        """Return the cached text (or None) of each entry which is present and has not expired."""
+        min_fetched_at = 0
+        if self.ttl_days is not None:
+            min_fetched_at = time.time() - self.ttl_days * 86400
+
+        cached = {}
+        for kegg_key_chunk in chunks(kegg_keys, 500):
+            cached.update(self.conn.execute(
+                """SELECT kegg_key, entry FROM raw_entry
+                WHERE fetched_at >= ? AND kegg_key IN ({})""".format(
+                    ",".join(["?"] * len(kegg_key_chunk))
+                ),
+                [min_fetched_at] + list(kegg_key_chunk)
+            ).fetchall())
+
+        self.hits += len(cached)
+        self.misses += len(kegg_keys) - len(cached)
+        return cached
+
+    def put(self, entries):
+        """Save the text (or None, if not in KEGG) of a set of entries."""
+        fetched_at = time.time()
+        self.conn.executemany(
+            """INSERT OR REPLACE INTO raw_entry
+            (kegg_key, entry, fetched_at, kegg_release)
+            VALUES (?, ?, ?, ?);""",
+            [
+                (kegg_key, entry, fetched_at, self.kegg_release)
+                for kegg_key, entry in entries.items()
+            ]
         )
+        self.conn.commit()
 
-    re_compound = re.compile(r'((?P<stoich>\d+)\s+|)(?P<compound_id>(?P<type>G|C)\d+)')
-    pathways = set()
-    compound_ids = set()
-    for rxn_id_chunk_i, rxn_id_chunk in enumerate(chunks(reaction_ids_needed, chunk_size)):
-        logging.info("Working on reaction chunk {:,} of {:,}".format(
-            rxn_id_chunk_i + 1,
-            int(len(reaction_ids_needed) / chunk_size) + 1
-        ))
-        raw_rxn_data = kegg_pool.map(
-            partial(
-                fetch_kegg_api,
-                data_type='rn'),
-            list(rxn_id_chunk)
+    def log_stats(self):
+        logging.info("KEGG cache: {:,} hits, {:,} misses".format(self.hits, self.misses))
+
+    def close(self):
+        self.conn.close()
+
+
+class TokenBucket(object):
+    """Limit the rate of requests, allowing short bursts up to the capacity of the bucket."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        # No requests are made until this time (e.g. after a Retry-After)
+        self.paused_until = 0
+        self.lock = None
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        # The lock is made inside the running event loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class KeggClient(object):
+    """Fetch entries from the KEGG API over one pool of connections, at a limited rate."""
+
+    def __init__(
+        self,
+        kegg_url=KEGG_URL,
+        threads=1,
+        requests_per_second=3,
+        max_retries=5,
+        backoff=1.0,
+        cache=None,
+        offline=False,
+        metrics=None
+    ):
+        self.kegg_url = kegg_url.rstrip("/")
+        self.threads = threads
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache
+        self.offline = offline
+        self.loop = asyncio.new_event_loop()
+        self.bucket = TokenBucket(requests_per_second)
+        self.session = None
+        self.metrics = metrics if metrics is not None else CrawlMetrics()
+
+    async def get(self, path):
+        """Make a single GET request, returning the status and text of the response."""
+        # aiohttp is only imported when connecting to KEGG, not for offline runs
+        import aiohttp
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.threads),
+                timeout=aiohttp.ClientTimeout(total=300)
             )
-        logging.info("Inserting {} reactions".format(
-            len(raw_rxn_data)
+
+        url = "{}/{}".format(self.kegg_url, path)
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            start = time.monotonic()
+            try:
+                async with self.session.get(url) as r:
+                    body = await r.read()
+                    text = await r.text()
+                    status = r.status
+                    retry_after = r.headers.get("Retry-After")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, body, text, retry_after = None, b"", str(e), None
+            self.metrics.observe("fetch", time.monotonic() - start)
+            self.metrics.count("fetch", "requests")
+            self.metrics.count("fetch", "bytes", len(body))
+            self.metrics.count("fetch", "status_{}".format(status))
+
+            # 404 means that none of the requested entries exist
+            if status in (200, 404):
+                return status, text
+
+            if attempt == self.max_retries:
+                break
+
+            # Back off with jitter, or for as long as the server asks
+            self.metrics.count("fetch", "retries")
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+                self.bucket.pause(delay)
+            logging.warning("Request for {} failed ({}), retrying in {:.1f}s".format(
+                url, status, delay
+            ))
+            await asyncio.sleep(delay)
+
+        self.metrics.count("fetch", "failures")
+        raise Exception("Request for {} failed after {:,} attempts ({}): {}".format(
+            url, self.max_retries + 1, status, text[:200]
         ))
+
+    async def fetch_release(self):
+        """Get the release of KEGG being served by the API."""
+        status, text = await self.get("info/kegg")
+        for line in text.split("\n"):
+            if "Release" in line:
+                return line.split("Release", 1)[1].strip()
+        raise Exception("Could not find the KEGG release in: " + text)
+
+    def get_release(self):
+        return self.loop.run_until_complete(self.fetch_release())
+
+    async def fetch_bulk(self, path):
+        """Fetch the text of a bulk endpoint (e.g. link/rn/ko), checking the cache first.
+
+        Returns None when offline and the endpoint is not in the cache.
+        """
+        kegg_key = "bulk:" + path
+        if self.cache is not None:
+            cached = self.cache.get([kegg_key])
+            if kegg_key in cached:
+                return cached[kegg_key] or ""
+
+        if self.offline:
+            logging.warning("Not in the KEGG cache: " + kegg_key)
+            return None
+
+        status, text = await self.get(path)
+        if status == 404:
+            text = ""
+        if self.cache is not None:
+            self.cache.put({kegg_key: text})
+        return text
+
+    async def fetch_batch(self, kegg_keys):
+        """Fetch up to 10 KEGG entries in a single request, returning the text of each (or None)."""
+        assert len(kegg_keys) <= KEGG_BATCH_SIZE, len(kegg_keys)
+
+        status, text = await self.get("get/{}".format("+".join(kegg_keys)))
+        if status == 404:
+            text = ""
+
+        entries = kegg_flatfile.split_entries(text)
+        return {
+            kegg_key: entries.get(kegg_key.split(":", 1)[1])
+            for kegg_key in kegg_keys
+        }
+
+    async def iter_batches(self, kegg_keys):
+        """Yield the text (or None) of KEGG entries in batches, as soon as each batch is available.
+
+        Each batch comes with an error message, which is None unless the entries could not be
+        fetched (as opposed to not existing in KEGG).
+        """
+
+        # Check the cache before making any requests
+        if self.cache is not None:
+            cached = self.cache.get(kegg_keys)
+        else:
+            cached = {}
+        if len(cached) > 0:
+            yield cached, None
+
+        kegg_keys_needed = [
+            kegg_key for kegg_key in kegg_keys if kegg_key not in cached
+        ]
+        if len(kegg_keys_needed) == 0:
+            return
+
+        if self.offline:
+            logging.warning("Not in the KEGG cache: {}".format(", ".join(kegg_keys_needed)))
+            yield {kegg_key: None for kegg_key in kegg_keys_needed}, "Not in the KEGG cache"
+            return
+
+        # Batches are yielded in the order they finish
+        for batch in asyncio.as_completed([
+            self.fetch_batch_or_fail(kegg_key_batch)
+            for kegg_key_batch in chunks(kegg_keys_needed, KEGG_BATCH_SIZE)
+        ]):
+            batch, error = await batch
+            if self.cache is not None and error is None:
+                self.cache.put(batch)
+            yield batch, error
+
+    async def fetch_batch_or_fail(self, kegg_keys):
+        """Fetch a batch of entries, returning the error instead of raising it."""
         try:
-            c.executemany(
-                """INSERT OR REPLACE INTO reaction
-                    (reaction_id, definition, equation, enzyme)
-                    VALUES (?, ?, ?, ?);
-                """,
-                [(
-                    sql_safe_string(rxn_id),
-                    sql_safe_string(rxn_data.get("DEFINITION", [""])[0]),
-                    sql_safe_string(rxn_data.get("EQUATION", [""])[0]),
-                    sql_safe_string(rxn_data.get("ENZYME", [""])[0]),
-                ) for (rxn_id, rxn_data) in zip(rxn_id_chunk, raw_rxn_data)
-                ]
-            )
-            conn.commit()
+            return await self.fetch_batch(kegg_keys), None
         except Exception as e:
-            logging.error("Insertion of reactions failed with exception {}".format(e))
-            assert 1 == 0
-
-        logging.info("Parsing reaction equations")
-        for rxn_id, rrd in zip(rxn_id_chunk, raw_rxn_data):
-            if 'EQUATION' not in rrd:
-                logging.warning("{} has no equation".format(
-                    rxn_id
-                ))
-            # implicit else
-            e = rrd['EQUATION'][0]
-            # Split the equation by =
-            e_L, e_R = e.split("=")
-            # Determine directionality
-            if e_L[-1] == "<" and e_R[0] == ">":
-                rrd['direction'] = 2
-            elif e_L[-1] == "<":
-                rrd['direction'] = 1
-            elif e_R[0] == ">":
-                rrd['direction'] = 0
-            else:
-                rrd['direction'] = -1
-            c.execute(
-                "UPDATE reaction SET direction = ? WHERE reaction_id ==?",
-                (rrd['direction'], rxn_id)
-                )
-            # And compounds
-            L_compounds = [re_compound.search(c.strip()) for c in e_L[:-1].split(' + ')]
-            R_compounds = [re_compound.search(c.strip()) for c in e_R[1:].split(' + ')]
-            logging.info("Inserting {:,} reaction-compound links".format(
-                len(L_compounds)+len(R_compounds)
-            ))
+            logging.warning("Could not fetch {}: {}".format(", ".join(kegg_keys), e))
+            return {kegg_key: None for kegg_key in kegg_keys}, str(e)
+
+    def log_stats(self):
+        """Log the number of requests made and the distribution of their latency."""
+        latency = self.metrics.histogram("fetch")
+        if latency is None:
+            return
+        logging.info("Made {:,} requests to KEGG ({:,} retries), latency p50={:.3f}s p90={:.3f}s p99={:.3f}s max={:.3f}s".format(
+            latency["n"],
+            self.metrics.counters["fetch"]["retries"],
+            latency["p50"],
+            latency["p90"],
+            latency["p99"],
+            latency["max"]
+        ))
+
+    def close(self):
+        if self.session is not None:
+            self.loop.run_until_complete(self.session.close())
+        self.loop.close()
+
+
+class SQLiteWriter(object):
+    """Insert rows into SQLite from a single thread, which drains a bounded queue.
+
+    In bulk-load mode, rows are collected across many items in the queue
+    and inserted with large executemany calls in a few transactions.
+    """
+
+    def __init__(self, db_path, max_queue=100, bulk_load=False, batch_rows=100000, metrics=None):
+        self.db_path = db_path
+        self.metrics = metrics if metrics is not None else CrawlMetrics()
+        self.queue = queue.Queue(max_queue)
+        self.bulk_load = bulk_load
+        self.batch_rows = batch_rows
+        self.error = None
+        self.n_rows = 0
+        self.seconds = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, conn, inserts):
+        start = time.monotonic()
+        n_rows = 0
+        for sql, rows in inserts.items():
+            conn.executemany(sql, rows)
+            n_rows += len(rows)
+        conn.commit()
+        self.n_rows += n_rows
+        self.seconds += time.monotonic() - start
+        self.metrics.observe("insert", time.monotonic() - start)
+        self.metrics.count("insert", "rows", n_rows)
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path)
+        if self.bulk_load:
+            set_bulk_load_pragmas(conn)
+
+        # Rows which have not been inserted yet (bulk-load only)
+        pending = defaultdict(list)
+        n_pending = 0
+
+        while True:
+            inserts = self.queue.get()
             try:
-                c.executemany(
-                    """INSERT OR REPLACE INTO reaction_compound
-                        (reaction_id, compound_id, side, stoichiometry)
-                        VALUES (?, ?, ?, ?)
-                    """,
-                    [
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("L"),
-                            sql_safe_string(m.group('stoich'))
-                        ) if m.group('stoich') != None
-                        else
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("L"),
-                            sql_safe_string(str(1))
-                        )
-                        for m in L_compounds
-                    ]+[
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("R"),
-                            sql_safe_string(m.group('stoich'))
-                        ) if m.group('stoich') != None
-                        else
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("R"),
-                            sql_safe_string(str(1))
-                        )
-                        for m in R_compounds
-                    ]
-                )
-                conn.commit()
+                if self.error is not None:
+                    pass
+                elif inserts is FLUSH or inserts is None:
+                    self.write(conn, pending)
+                    pending, n_pending = defaultdict(list), 0
+                elif self.bulk_load:
+                    for sql, rows in inserts.items():
+                        pending[sql].extend(rows)
+                        n_pending += len(rows)
+                    if n_pending >= self.batch_rows:
+                        self.write(conn, pending)
+                        pending, n_pending = defaultdict(list), 0
+                else:
+                    self.write(conn, inserts)
             except Exception as e:
-                logging.error("Insertion of reaction-compound failed with exception {}".format(e))
-                assert 1 == 0
-            compound_ids.update({m.group('compound_id') for m in L_compounds+R_compounds})
-
-            rxn_pathway = [
-                (sql_safe_string(rxn_id), sql_safe_string(p.split(" ", 1)[0]))
-                for rxn_id, rxn in zip(rxn_id_chunk, raw_rxn_data)
-                for p in rxn['PATHWAY']
-            ]
-            logging.info("Now working on {:,} reaction-pathway links".format(
-                len(rxn_pathway)
+                logging.error("Insertion failed with exception {}".format(e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if inserts is None:
+                conn.close()
+                return
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, inserts):
+        """Queue a dict of rows to insert, keyed by SQL statement."""
+        self.check()
+        self.queue.put(inserts)
+
+    def flush(self):
+        """Wait for everything in the queue to be written."""
+        self.queue.put(FLUSH)
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+        if self.seconds > 0:
+            logging.info("Inserted {:,} rows in {:.1f}s ({:,.0f} rows/s)".format(
+                self.n_rows,
+                self.seconds,
+                self.n_rows / self.seconds
             ))
-            pathways.update({rp[1] for rp in rxn_pathway})
-            try:
-                c.executemany(
-                    """INSERT OR REPLACE INTO pathway_reaction
-                        (reaction_id,pathway_id)
-                        VALUES (?,?)""",
-                    rxn_pathway
-                )
-                conn.commit()
-            except Exception as e:
-                logging.error("Insertion of reaction-pathway failed with exception {}".format(e))
-                assert 1 == 0
-
-    # Pathways
-    c.execute("SELECT pathway_id from pathway;")
-    existing_pathways = {i[0] for i in c.fetchall()}
-    c.execute("SELECT DISTINCT pathway_id from pathway_reaction;")
-    pathway_links = {i[0] for i in c.fetchall()}
-    pathways_needed = list(pathways.union(pathway_links) - existing_pathways)
-    logging.info("We need to download {:,} pathways".format(len(pathways_needed)))
-    for id_chunk_i, id_chunk in enumerate(chunks(pathways_needed, chunk_size)):
-        logging.info("Working on pathway chunk {:,} of {:,}".format(
-            id_chunk_i + 1,
-            int(len(pathways_needed) / chunk_size) + 1
+
+
+# Marker telling the writer to insert any rows it is holding, which is never equal to a batch
+FLUSH = object()
+
+
+def set_bulk_load_pragmas(conn):
+    """Trade durability for speed while loading, since a failed load can be rerun."""
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=OFF;")
+
+
+# Version of the database schema, stored as the user_version of the database
+SCHEMA_VERSION = 2
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS ortholog
+    (ortholog_id TEXT PRIMARY KEY, name TEXT, definition TEXT);""",
+    """CREATE TABLE IF NOT EXISTS reaction
+    (reaction_id TEXT PRIMARY KEY, definition TEXT, equation TEXT, enzyme TEXT,
+    direction INT);""",
+    """CREATE TABLE IF NOT EXISTS compound
+    (compound_id TEXT PRIMARY KEY, formula TEXT);""",
+    """CREATE TABLE IF NOT EXISTS pathway
+    (pathway_id TEXT PRIMARY KEY, name TEXT, class TEXT, description TEXT);""",
+    """CREATE TABLE IF NOT EXISTS module
+    (module_id TEXT PRIMARY KEY, name TEXT, class TEXT);""",
+    """CREATE TABLE IF NOT EXISTS compound_name
+    (compound_id TEXT, name TEXT, PRIMARY KEY(compound_id, name))
+    WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS ortholog_has_reaction
+    (ortholog_id TEXT, reaction_id TEXT, PRIMARY KEY(ortholog_id, reaction_id))
+    WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS reaction_compound
+    (reaction_id TEXT, compound_id TEXT, stoichiometry INT, side TEXT,
+    PRIMARY KEY(reaction_id, compound_id))
+    WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS module_pathway
+    (module_id TEXT, pathway_id TEXT, PRIMARY KEY(module_id, pathway_id))
+    WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS module_compound
+    (module_id TEXT, compound_id TEXT, PRIMARY KEY(module_id, compound_id))
+    WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS module_reaction
+    (module_id TEXT, reaction_id TEXT, PRIMARY KEY(module_id, reaction_id))
+    WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS pathway_compound
+    (pathway_id TEXT, compound_id TEXT, PRIMARY KEY(pathway_id, compound_id))
+    WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS pathway_reaction
+    (pathway_id TEXT, reaction_id TEXT, PRIMARY KEY(pathway_id, reaction_id))
+    WITHOUT ROWID;""",
+    # Queries are by far the largest set of IDs, so each is stored once and
+    # referred to by an integer key
+    """CREATE TABLE IF NOT EXISTS query
+    (query_ix INTEGER PRIMARY KEY, query_id TEXT NOT NULL UNIQUE);""",
+    """CREATE TABLE IF NOT EXISTS query_ko
+    (query_ix INTEGER, ortholog_id TEXT, PRIMARY KEY(query_ix, ortholog_id))
+    WITHOUT ROWID;""",
+    # The state of every entry in the crawl (queued, fetched, failed or retried),
+    # so that an interrupted crawl can be resumed. Entries which KEGG does not
+    # have are fetched with found = 0, while failed requests are retried.
+    """CREATE TABLE IF NOT EXISTS crawl_queue
+    (data_type TEXT, kegg_id TEXT, expand INT, state TEXT, found INT,
+    attempts INT, last_error TEXT, updated_at REAL,
+    PRIMARY KEY(data_type, kegg_id))
+    WITHOUT ROWID;""",
+    """CREATE VIEW IF NOT EXISTS query_ortholog AS
+    SELECT query.query_id, query_ko.ortholog_id
+    FROM query_ko JOIN query USING (query_ix);""",
+]
+
+# Indexes for following each link in the reverse direction (e.g. ortholog -> query),
+# which are created after a bulk load
+INDEXES = [
+    ("ortholog_has_reaction_rev_ix", "ortholog_has_reaction", "reaction_id, ortholog_id"),
+    ("reaction_compound_rev_ix", "reaction_compound", "compound_id, reaction_id"),
+    ("module_pathway_rev_ix", "module_pathway", "pathway_id, module_id"),
+    ("module_compound_rev_ix", "module_compound", "compound_id, module_id"),
+    ("module_reaction_rev_ix", "module_reaction", "reaction_id, module_id"),
+    ("pathway_compound_rev_ix", "pathway_compound", "compound_id, pathway_id"),
+    ("pathway_reaction_rev_ix", "pathway_reaction", "reaction_id, pathway_id"),
+    ("query_ko_rev_ix", "query_ko", "ortholog_id, query_ix"),
+]
+
+# Columns of each table which are copied over from the unversioned schema
+MIGRATE_V1 = [
+    ("ortholog", "ortholog_id, name, definition"),
+    ("reaction", "reaction_id, definition, equation, enzyme, direction"),
+    ("compound", "compound_id, formula"),
+    ("pathway", "pathway_id, name, class, description"),
+    ("module", "module_id, name, class"),
+    ("compound_name", "compound_id, name"),
+    ("ortholog_has_reaction", "ortholog_id, reaction_id"),
+    ("reaction_compound", "reaction_id, compound_id, stoichiometry, side"),
+    ("module_pathway", "module_id, pathway_id"),
+    ("module_compound", "module_id, compound_id"),
+    ("module_reaction", "module_id, reaction_id"),
+    ("pathway_compound", "pathway_id, compound_id"),
+    ("pathway_reaction", "pathway_id, reaction_id"),
+]
+
+
+def create_indexes(c):
+    for index_name, table, columns in INDEXES:
+        c.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({});".format(
+            index_name,
+            table,
+            columns
         ))
-        raw_data = kegg_pool.map(
-            partial(
-                fetch_kegg_api,
-                data_type='path'),
-            list(id_chunk)
-            )
-        logging.info("Inserting {:,} pathways".format(len(raw_data)))
-        c.executemany(
-            """INSERT OR REPLACE INTO pathway
-            (pathway_id, name, class, description)
-            VALUES (?, ?, ?, ?)
-            """,
-            [(
-                sql_safe_string(path_id),
-                sql_safe_string(path_data.get('NAME', [''])[0]),
-                sql_safe_string(path_data.get('CLASS', [''])[0]),
-                sql_safe_string(path_data.get('DESCRIPTION', [''])[0]),
+
+
+def migrate_schema_v1(c):
+    """Move the data from a database made before the schema was versioned."""
+    logging.info("Migrating the database to schema version {}".format(SCHEMA_VERSION))
+    c.execute("ALTER TABLE query_ortholog RENAME TO query_ortholog_v1;")
+    for table, _ in MIGRATE_V1:
+        c.execute("ALTER TABLE {table} RENAME TO {table}_v1;".format(table=table))
+
+    for sql in SCHEMA:
+        c.execute(sql)
+
+    # Later rows replaced earlier ones in the old tables, so they do here too
+    for table, columns in MIGRATE_V1:
+        c.execute(
+            """INSERT OR REPLACE INTO {table} ({columns})
+            SELECT {columns} FROM {table}_v1 ORDER BY rowid;""".format(
+                table=table,
+                columns=columns
             )
-                for path_id, path_data in
-                zip(id_chunk, raw_data)]
         )
-        c.executemany(
+        c.execute("DROP TABLE {}_v1;".format(table))
+
+    c.execute(
+        """INSERT OR IGNORE INTO query (query_id)
+        SELECT DISTINCT query_id FROM query_ortholog_v1;"""
+    )
+    c.execute(
+        """INSERT OR IGNORE INTO query_ko (query_ix, ortholog_id)
+        SELECT query.query_ix, query_ortholog_v1.ortholog_id
+        FROM query_ortholog_v1 JOIN query USING (query_id);"""
+    )
+    c.execute("DROP TABLE query_ortholog_v1;")
+
+
+def create_schema(c, bulk_load=False):
+    """Create the tables (migrating an older database), deferring the indexes for a bulk load."""
+    # WAL mode can only be switched on outside of a transaction
+    if bulk_load:
+        set_bulk_load_pragmas(c)
+
+    user_version = c.execute("PRAGMA user_version;").fetchone()[0]
+    assert user_version <= SCHEMA_VERSION, \
+        "Database has schema version {}, newer than {}".format(user_version, SCHEMA_VERSION)
+
+    has_tables = c.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type='table' AND name='ortholog';"
+    ).fetchone()[0] > 0
+    if user_version < SCHEMA_VERSION and has_tables:
+        migrate_schema_v1(c)
+
+    for sql in SCHEMA:
+        c.execute(sql)
+    c.execute("PRAGMA user_version = {};".format(SCHEMA_VERSION))
+
+    if bulk_load:
+        for index_name, _, _ in INDEXES:
+            c.execute("DROP INDEX IF EXISTS {};".format(index_name))
+    else:
+        create_indexes(c)
+
+
+# Common join paths, timed by --benchmark
+BENCHMARK_QUERIES = [
+    ("query -> reaction", """SELECT count(*) FROM query_ortholog
+        JOIN ortholog_has_reaction USING (ortholog_id);"""),
+    ("query -> compound", """SELECT count(*) FROM query_ortholog
+        JOIN ortholog_has_reaction USING (ortholog_id)
+        JOIN reaction_compound USING (reaction_id)
+        JOIN compound USING (compound_id);"""),
+    ("query -> pathway", """SELECT count(DISTINCT query_id), count(DISTINCT pathway_id) FROM query_ortholog
+        JOIN ortholog_has_reaction USING (ortholog_id)
+        JOIN pathway_reaction USING (reaction_id)
+        JOIN pathway USING (pathway_id);"""),
+    ("compound -> query", """SELECT count(*) FROM compound
+        JOIN reaction_compound USING (compound_id)
+        JOIN ortholog_has_reaction USING (reaction_id)
+        JOIN query_ko USING (ortholog_id);"""),
+    ("module -> ortholog", """SELECT count(*) FROM module
+        JOIN module_reaction USING (module_id)
+        JOIN ortholog_has_reaction USING (reaction_id)
+        JOIN ortholog USING (ortholog_id);"""),
+]
+
+
+def benchmark_queries(c, repeats=3):
+    """Log the time taken by the common join paths through the database."""
+    for label, sql in BENCHMARK_QUERIES:
+        timings = []
+        for _ in range(repeats):
+            start = time.monotonic()
+            result = c.execute(sql).fetchone()
+            timings.append(time.monotonic() - start)
+        logging.info("Query {}: {} in {:.4f}s (best of {})".format(
+            label,
+            result,
+            min(timings),
+            repeats
+        ))
+
+
+def parse_ortholog(ortholog, inserts, neighbors, expand):
+    inserts[
+        """INSERT OR REPLACE INTO ORTHOLOG
+            (ortholog_id, name, definition)
+            VALUES (?, ?, ?);"""
+    ].append((
+        sql_safe_string(ortholog.ortholog_id),
+        sql_safe_string(ortholog.name),
+        sql_safe_string(ortholog.definition),
+    ))
+
+    # Links to reactions
+    for rxn_id in ortholog.reactions:
+        inserts[
+            """INSERT OR REPLACE INTO ortholog_has_reaction
+                (ortholog_id, reaction_id)
+                VALUES (?, ?)
+            """
+        ].append((sql_safe_string(ortholog.ortholog_id), sql_safe_string(rxn_id)))
+        neighbors['rn'].add(rxn_id)
+
+
+def parse_reaction(reaction, inserts, neighbors, expand):
+    if reaction.direction is None:
+        logging.warning("{} has no equation".format(
+            reaction.reaction_id
+        ))
+
+    inserts[
+        """INSERT OR REPLACE INTO reaction
+            (reaction_id, definition, equation, enzyme, direction)
+            VALUES (?, ?, ?, ?, ?);
+        """
+    ].append((
+        sql_safe_string(reaction.reaction_id),
+        sql_safe_string(reaction.definition),
+        sql_safe_string(reaction.equation),
+        sql_safe_string(reaction.enzyme),
+        reaction.direction,
+    ))
+
+    # Links to pathways are only followed for the reactions of the orthologs
+    if expand:
+        for path_id in reaction.pathways:
+            inserts[
+                """INSERT OR REPLACE INTO pathway_reaction
+                    (reaction_id,pathway_id)
+                    VALUES (?,?)"""
+            ].append((sql_safe_string(reaction.reaction_id), sql_safe_string(path_id)))
+            neighbors['path'].add(path_id)
+
+    # And compounds
+    for comp_id, side, stoichiometry in reaction.compounds:
+        inserts[
+            """INSERT OR REPLACE INTO reaction_compound
+                (reaction_id, compound_id, side, stoichiometry)
+                VALUES (?, ?, ?, ?)
+            """
+        ].append((
+            sql_safe_string(reaction.reaction_id),
+            sql_safe_string(comp_id),
+            sql_safe_string(side),
+            sql_safe_string(stoichiometry)
+        ))
+        neighbors['cpd' if comp_id[0] == 'C' else 'gl'].add(comp_id)
+
+
+def parse_pathway(pathway, inserts, neighbors, expand):
+    path_id = sql_safe_string(pathway.pathway_id)
+    inserts[
+        """INSERT OR REPLACE INTO pathway
+        (pathway_id, name, class, description)
+        VALUES (?, ?, ?, ?)
+        """
+    ].append((
+        path_id,
+        sql_safe_string(pathway.name),
+        sql_safe_string(pathway.pathway_class),
+        sql_safe_string(pathway.description),
+    ))
+    for rxn in pathway.reactions:
+        inserts[
             """INSERT OR REPLACE INTO pathway_reaction
             (pathway_id, reaction_id)
             VALUES (?, ?)
-            """,
-            [(
-                sql_safe_string(path_id),
-                sql_safe_string(rxn)
-            )
-                for path_id, path_data in
-                zip(id_chunk, raw_data)
-                for rxn_block in path_data['REACTION']
-                for rxn in rxn_block.split(' ')[0].split(',')
-                ]
-        )
-        c.executemany(
+            """
+        ].append((path_id, sql_safe_string(rxn)))
+        neighbors['rn'].add(rxn)
+    for comp in pathway.compounds:
+        inserts[
             """INSERT OR REPLACE INTO pathway_compound
             (pathway_id, compound_id)
             VALUES (?, ?)
-            """,
-            [(
-                sql_safe_string(path_id),
-                sql_safe_string(comp.split(" ")[0].strip())
-            )
-                for path_id, path_data in
-                zip(id_chunk, raw_data)
-                for comp in path_data['COMPOUND']
-                ]
-        )
-        c.executemany(
+            """
+        ].append((path_id, sql_safe_string(comp)))
+    for mod in pathway.modules:
+        inserts[
             """INSERT OR REPLACE INTO module_pathway
             (pathway_id, module_id)
             VALUES (?, ?)
-            """,
-            [(
-                sql_safe_string(path_id),
-                sql_safe_string(mod.split(" ")[0].strip())
-            )
-                for path_id, path_data in
-                zip(id_chunk, raw_data)
-                for mod in path_data['MODULE']
-                ]
-        )
+            """
+        ].append((path_id, sql_safe_string(mod)))
+        neighbors['md'].add(mod)
 
-        conn.commit()
 
-    # Modules
-    c.execute("SELECT module_id from module;")
-    existing_modules = {i[0] for i in c.fetchall()}
-    c.execute("SELECT DISTINCT module_id from module_pathway;")
-    module_links = {i[0] for i in c.fetchall()}
-    modules_needed = list(module_links - existing_modules)
-    logging.info("We need to download {:,} modules".format(len(modules_needed)))
-    for id_chunk_i, id_chunk in enumerate(chunks(modules_needed, chunk_size)):
-        logging.info("Working on module chunk {:,} of {:,}".format(
-            id_chunk_i + 1,
-            int(len(modules_needed) / chunk_size) + 1
-        ))
-        raw_data = kegg_pool.map(
-            partial(
-                fetch_kegg_api,
-                data_type='md'),
-            list(id_chunk)
-            )
-        logging.info("Inserting {:,} modules".format(len(raw_data)))
-        c.executemany(
-            """INSERT OR REPLACE INTO module
-            (module_id, name, class)
-            VALUES (?,?,?)
-            """,
-            [(
-                sql_safe_string(mod_id),
-                sql_safe_string(mod_data.get('NAME', [''])[0]),
-                sql_safe_string(mod_data.get('CLASS', [''])[0]),
-            )
-                for mod_id, mod_data in
-                zip(id_chunk, raw_data)]
-        )
-        c.executemany(
+def parse_module(module, inserts, neighbors, expand):
+    mod_id = sql_safe_string(module.module_id)
+    inserts[
+        """INSERT OR REPLACE INTO module
+        (module_id, name, class)
+        VALUES (?,?,?)
+        """
+    ].append((
+        mod_id,
+        sql_safe_string(module.name),
+        sql_safe_string(module.module_class),
+    ))
+    for comp in module.compounds:
+        inserts[
             """INSERT OR REPLACE INTO module_compound
             (module_id, compound_id)
             VALUES (?,?)
-            """,
-            [(
-                sql_safe_string(mod_id),
-                sql_safe_string(comp.split(" ")[0].strip())
-            )
-                for mod_id, mod_data in
-                zip(id_chunk, raw_data)
-                for comp in mod_data['COMPOUND']
-                ]
-        )
-        c.executemany(
+            """
+        ].append((mod_id, sql_safe_string(comp)))
+    for rxn in module.reactions:
+        inserts[
             """INSERT OR REPLACE INTO module_reaction
             (module_id, reaction_id)
             VALUES (?,?)
-            """,
-            [(
-                sql_safe_string(mod_id),
-                sql_safe_string(rxn)
-            )
-                for mod_id, mod_data in
-                zip(id_chunk, raw_data)
-                for rxn_block in mod_data['REACTION']
-                for rxn in rxn_block.split(' ')[0].split(',')
-                ]
+            """
+        ].append((mod_id, sql_safe_string(rxn)))
+        neighbors['rn'].add(rxn)
+
+
+def parse_compound(compound, inserts, neighbors, expand):
+    inserts[
+        """INSERT OR REPLACE INTO compound
+            (compound_id, formula)
+            VALUES (?, ?)
+        """
+    ].append((compound.compound_id, compound.formula))
+    for name in compound.names:
+        inserts[
+            """INSERT OR REPLACE INTO compound_name
+            (compound_id, name)
+            VALUES (?,?)
+            """
+        ].append((compound.compound_id, name))
+
+
+# Functions used to format the rows for each type of KEGG record
+KEGG_PARSERS = {
+    'ko': parse_ortholog,
+    'rn': parse_reaction,
+    'path': parse_pathway,
+    'md': parse_module,
+    'cpd': parse_compound,
+    'gl': parse_compound,
+}
+
+
+def process_kegg_entries(data_type, entries, expand=True):
+    """Parse a list of (ID, text) KEGG entries, returning the rows to insert and the IDs linked to."""
+    inserts = defaultdict(list)
+    neighbors = defaultdict(set)
+    for kegg_id, entry in entries:
+        KEGG_PARSERS[data_type](
+            kegg_flatfile.parse_entry(data_type, kegg_id, entry),
+            inserts,
+            neighbors,
+            expand
         )
-        conn.commit()
+    return dict(inserts), dict(neighbors)
 
-    # Revisit reactions to capture everything in our modules / pathways
-    # (but no further spinning out from here)
-    c.execute("SELECT DISTINCT reaction_id FROM pathway_reaction;")
-    rxn_link_path = {i[0] for i in c.fetchall()}
-    c.execute("SELECT DISTINCT reaction_id FROM module_reaction;")
-    rxn_link_mod = {i[0] for i in c.fetchall()}
-    c.execute("SELECT reaction_id from reaction;")
-    existing_rxn = {i[0] for i in c.fetchall()}
-    rxn_needed = list(rxn_link_mod.union(rxn_link_path) - existing_rxn)
-    logging.info("Downloading {:,} more reactions from pathways and modules".format(
-        len(rxn_needed)))
-    for rxn_id_chunk_i, rxn_id_chunk in enumerate(chunks(rxn_needed, chunk_size)):
-        logging.info("Working on reaction chunk {:,} of {:,}".format(
-            rxn_id_chunk_i + 1,
-            int(len(rxn_needed) / chunk_size) + 1
-        ))
-        raw_rxn_data = kegg_pool.map(
-            partial(
-                fetch_kegg_api,
-                data_type='rn'),
-            list(rxn_id_chunk)
-            )
-        logging.info("Inserting {} reactions".format(
-            len(raw_rxn_data)
+
+# Every change to the state of an entry in the crawl goes through the same statement,
+# so that the writer applies them in order
+CRAWL_QUEUE_SQL = """INSERT INTO crawl_queue
+    (data_type, kegg_id, expand, state, found, attempts, last_error, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(data_type, kegg_id) DO UPDATE SET
+    expand=excluded.expand, state=excluded.state, found=excluded.found,
+    attempts=crawl_queue.attempts + excluded.attempts,
+    last_error=excluded.last_error, updated_at=excluded.updated_at
+"""
+
+
+def crawl_state(data_type, kegg_id, expand, state, found=None, attempts=0, last_error=None):
+    """Row for CRAWL_QUEUE_SQL, where attempts is added to the number made so far."""
+    return (data_type, kegg_id, int(expand), state, found, attempts, last_error, time.time())
+
+
+async def run_kegg_pipeline(kegg, kegg_ids, data_type, writer, executor, chunk_size, expand=True):
+    """Fetch, parse and insert a set of KEGG entries, with every stage running concurrently.
+
+    Returns the IDs linked to by these entries, and the IDs which could not be fetched.
+    """
+    loop = asyncio.get_event_loop()
+    neighbors = defaultdict(set)
+    failed = []
+
+    async def parse_and_insert(entries):
+        start = time.monotonic()
+        inserts, chunk_neighbors = await loop.run_in_executor(
+            executor,
+            process_kegg_entries,
+            data_type,
+            entries,
+            expand
+        )
+        kegg.metrics.observe("parse", time.monotonic() - start)
+        kegg.metrics.count("parse", data_type, len(entries))
+
+        # The entries are marked as fetched in the same transaction as their rows
+        inserts[CRAWL_QUEUE_SQL] = [
+            crawl_state(data_type, kegg_id, expand, "fetched", found=int(entry is not None), attempts=1)
+            for kegg_id, entry in entries
+        ]
+
+        # The queue is bounded, so wait for space without blocking the event loop
+        await loop.run_in_executor(None, writer.put, inserts)
+        for neighbor_type, neighbor_ids in chunk_neighbors.items():
+            neighbors[neighbor_type].update(neighbor_ids)
+
+    # Entries are parsed in chunks, as soon as enough have been downloaded
+    tasks = []
+    entries = []
+    async for batch, error in kegg.iter_batches([
+        "{}:{}".format(data_type, kegg_id) for kegg_id in kegg_ids
+    ]):
+        # Entries which could not be fetched are retried later, rather than saved as empty
+        if error is not None:
+            batch_ids = [kegg_key.split(":", 1)[1] for kegg_key in batch]
+            failed.extend(batch_ids)
+            kegg.metrics.count("parse", "failed", len(batch_ids))
+            await loop.run_in_executor(None, writer.put, {CRAWL_QUEUE_SQL: [
+                crawl_state(data_type, kegg_id, expand, "failed", attempts=1, last_error=error[:1000])
+                for kegg_id in batch_ids
+            ]})
+            continue
+
+        # Entries which KEGG does not have are left out of the response
+        missing = [kegg_key for kegg_key, entry in batch.items() if entry is None]
+        if len(missing) > 0:
+            logging.warning("Not found in KEGG: {}".format(", ".join(missing)))
+            kegg.metrics.count("parse", "missing", len(missing))
+
+        entries.extend([
+            (kegg_key.split(":", 1)[1], entry)
+            for kegg_key, entry in batch.items()
+        ])
+        while len(entries) >= chunk_size:
+            tasks.append(asyncio.ensure_future(parse_and_insert(entries[:chunk_size])))
+            entries = entries[chunk_size:]
+    if len(entries) > 0:
+        tasks.append(asyncio.ensure_future(parse_and_insert(entries)))
+
+    await asyncio.gather(*tasks)
+
+    return neighbors, failed
+
+
+def strip_kegg_prefix(kegg_id):
+    """Remove the database prefix from an ID (e.g. ko:K00001), using rn for reference pathways."""
+    kegg_id = kegg_id.strip().split(":", 1)[-1]
+    if kegg_id.startswith("map"):
+        kegg_id = "rn" + kegg_id[3:]
+    return kegg_id
+
+
+def parse_kegg_link(text):
+    """Parse the response from a KEGG link endpoint into a list of pairs of IDs."""
+    return [
+        tuple(strip_kegg_prefix(kegg_id) for kegg_id in line.split("\t", 1))
+        for line in text.split("\n")
+        if "\t" in line
+    ]
+
+
+async def fetch_kegg_bulk(kegg, kegg_ids):
+    """Fill in the orthologs and the links between entries from the bulk KEGG endpoints.
+
+    Returns the rows to insert, and the (type, ID, expand) seeds for fetching the
+    reactions, pathways and modules, which need fields only found in each entry.
+    When offline without the bulk endpoints in the cache, the orthologs are crawled
+    one entry at a time instead.
+    """
+    bulk = await asyncio.gather(*[
+        kegg.fetch_bulk(path)
+        for path in [
+            "list/ko",
+            "link/rn/ko",
+            "link/pathway/rn",
+            "link/module/pathway",
+            "link/rn/module",
+            "link/rn/pathway",
+            "link/compound/pathway",
+            "link/compound/module",
+        ]
+    ])
+    kegg_ids = set(kegg_ids)
+    if None in bulk:
+        logging.warning("The bulk KEGG endpoints are not in the cache, crawling the orthologs instead")
+        return {}, [('ko', kegg_id, True) for kegg_id in kegg_ids]
+
+    ortholog_list, ko_rn, rn_path, path_md, md_rn, path_rn, path_cpd, md_cpd = bulk
+    inserts = defaultdict(list)
+
+    # The name and definition of each ortholog are separated by '; '
+    ortholog_names = {}
+    for line in ortholog_list.split("\n"):
+        if "\t" in line:
+            ortholog_id, desc = line.split("\t", 1)
+            ortholog_names[strip_kegg_prefix(ortholog_id)] = (desc.split("; ", 1) + [""])[:2]
+    for kegg_id in kegg_ids:
+        name, definition = ortholog_names.get(kegg_id, ["", ""])
+        inserts[
+            """INSERT OR REPLACE INTO ORTHOLOG
+                (ortholog_id, name, definition)
+                VALUES (?, ?, ?);"""
+        ].append((
+            sql_safe_string(kegg_id),
+            sql_safe_string(name),
+            sql_safe_string(definition),
         ))
-        try:
-            c.executemany(
-                """INSERT OR REPLACE INTO reaction
-                    (reaction_id, definition, equation, enzyme)
-                    VALUES (?, ?, ?, ?);
-                """,
-                [(
-                    sql_safe_string(rxn_id),
-                    sql_safe_string(rxn_data.get("DEFINITION", [""])[0]),
-                    sql_safe_string(rxn_data.get("EQUATION", [""])[0]),
-                    sql_safe_string(rxn_data.get("ENZYME", [""])[0]),
-                ) for (rxn_id, rxn_data) in zip(rxn_id_chunk, raw_rxn_data)
-                ]
+
+    # The orthologs are recorded in the crawl queue, so that a later run does not fetch them
+    inserts[CRAWL_QUEUE_SQL] = [
+        crawl_state('ko', kegg_id, True, "fetched", found=int(kegg_id in ortholog_names), attempts=1)
+        for kegg_id in kegg_ids
+    ]
+
+    # Follow the links from the orthologs, with the same depth as the crawl
+    reactions = set()
+    for ortholog_id, rxn_id in parse_kegg_link(ko_rn):
+        if ortholog_id in kegg_ids:
+            inserts[
+                """INSERT OR REPLACE INTO ortholog_has_reaction
+                    (ortholog_id, reaction_id)
+                    VALUES (?, ?)
+                """
+            ].append((sql_safe_string(ortholog_id), sql_safe_string(rxn_id)))
+            reactions.add(rxn_id)
+
+    pathways = set()
+    for rxn_id, path_id in parse_kegg_link(rn_path):
+        if rxn_id in reactions and path_id.startswith("rn"):
+            pathways.add(path_id)
+
+    modules = set()
+    for path_id, mod_id in parse_kegg_link(path_md):
+        if path_id in pathways:
+            inserts[
+                """INSERT OR REPLACE INTO module_pathway
+                (pathway_id, module_id)
+                VALUES (?, ?)
+                """
+            ].append((sql_safe_string(path_id), sql_safe_string(mod_id)))
+            modules.add(mod_id)
+
+    other_reactions = set()
+    for (sql, ids, links) in [
+        ("""INSERT OR REPLACE INTO pathway_reaction
+            (pathway_id, reaction_id)
+            VALUES (?, ?)""", pathways, path_rn),
+        ("""INSERT OR REPLACE INTO module_reaction
+            (module_id, reaction_id)
+            VALUES (?,?)""", modules, md_rn),
+    ]:
+        for kegg_id, rxn_id in parse_kegg_link(links):
+            if kegg_id in ids:
+                inserts[sql].append((sql_safe_string(kegg_id), sql_safe_string(rxn_id)))
+                other_reactions.add(rxn_id)
+
+    for (sql, ids, links) in [
+        ("""INSERT OR REPLACE INTO pathway_compound
+            (pathway_id, compound_id)
+            VALUES (?, ?)""", pathways, path_cpd),
+        ("""INSERT OR REPLACE INTO module_compound
+            (module_id, compound_id)
+            VALUES (?,?)""", modules, md_cpd),
+    ]:
+        for kegg_id, comp_id in parse_kegg_link(links):
+            if kegg_id in ids:
+                inserts[sql].append((sql_safe_string(kegg_id), sql_safe_string(comp_id)))
+
+    logging.info("Linked {:,} orthologs to {:,} reactions, {:,} pathways and {:,} modules".format(
+        len(kegg_ids),
+        len(reactions),
+        len(pathways),
+        len(modules)
+    ))
+
+    seeds = [('rn', rxn_id, True) for rxn_id in reactions] + \
+        [('path', path_id, False) for path_id in pathways] + \
+        [('md', mod_id, False) for mod_id in modules] + \
+        [('rn', rxn_id, False) for rxn_id in other_reactions - reactions]
+
+    return dict(inserts), seeds
+
+
+def write_stoichiometry_matrix(conn, fp):
+    """Save the compound x reaction stoichiometric matrix of the reactions of the query orthologs.
+
+    The .npz can be read with scipy.sparse.load_npz, and also holds the labels of the rows
+    ('compounds') and columns ('reactions'), and the 'direction' of each reaction
+    (0: left to right, 1: right to left, 2: reversible, -1: unknown).
+    Compounds on the left of an equation are consumed (negative) and on the right produced.
+    """
+    # Only needed for the matrix, so that a crawl does not depend on numpy and scipy
+    import numpy as np
+    import scipy.sparse
+
+    reactions = conn.execute(
+        """SELECT reaction_id, direction FROM reaction
+        WHERE reaction_id IN (
+            SELECT reaction_id FROM ortholog_has_reaction JOIN query_ko USING (ortholog_id)
+        )
+        ORDER BY reaction_id;"""
+    ).fetchall()
+    reaction_ix = {reaction_id: ix for ix, (reaction_id, _) in enumerate(reactions)}
+
+    rows = [
+        (reaction_id, compound_id, stoichiometry, side)
+        for reaction_id, compound_id, stoichiometry, side in conn.execute(
+            "SELECT reaction_id, compound_id, stoichiometry, side FROM reaction_compound;"
+        )
+        if reaction_id in reaction_ix
+    ]
+    compounds = sorted(set([compound_id for _, compound_id, _, _ in rows]))
+    compound_ix = {compound_id: ix for ix, compound_id in enumerate(compounds)}
+
+    matrix = scipy.sparse.csr_matrix(
+        (
+            np.array([
+                -int(stoichiometry) if side == "L" else int(stoichiometry)
+                for _, _, stoichiometry, side in rows
+            ], dtype=np.int32),
+            (
+                np.array([compound_ix[compound_id] for _, compound_id, _, _ in rows], dtype=np.int64),
+                np.array([reaction_ix[reaction_id] for reaction_id, _, _, _ in rows], dtype=np.int64),
             )
-            conn.commit()
-        except Exception as e:
-            logging.error("Insertion of reactions failed with exception {}".format(e))
-            assert 1 == 0
-
-        logging.info("Parsing reaction equations")
-        for rxn_id, rrd in zip(rxn_id_chunk, raw_rxn_data):
-            if 'EQUATION' not in rrd:
-                logging.warning("{} has no equation".format(
-                    rxn_id
-                ))
-                continue
-            # Implicit else
-            e = rrd['EQUATION'][0]
-            # Split the equation by =
-            e_L, e_R = e.split("=")
-            # Determine directionality
-            if e_L[-1] == "<" and e_R[0] == ">":
-                rrd['direction'] = 2
-            elif e_L[-1] == "<":
-                rrd['direction'] = 1
-            elif e_R[0] == ">":
-                rrd['direction'] = 0
-            else:
-                rrd['direction'] = -1
-            c.execute(
-                "UPDATE reaction SET direction = ? WHERE reaction_id ==?",
-                (rrd['direction'], rxn_id)
-                )
-            # And compounds
-            L_compounds = [re_compound.search(c.strip()) for c in e_L[:-1].split(' + ')]
-            R_compounds = [re_compound.search(c.strip()) for c in e_R[1:].split(' + ')]
-            logging.info("Inserting {:,} reaction-compound links".format(
-                len(L_compounds)+len(R_compounds)
+        ),
+        shape=(len(compounds), len(reactions))
+    )
+    matrix.sum_duplicates()
+
+    np.savez_compressed(
+        fp,
+        format=np.array("csr"),
+        shape=np.array(matrix.shape),
+        data=matrix.data,
+        indices=matrix.indices,
+        indptr=matrix.indptr,
+        compounds=np.array(compounds, dtype=str),
+        reactions=np.array([reaction_id for reaction_id, _ in reactions], dtype=str),
+        direction=np.array([
+            direction if direction is not None else -1
+            for _, direction in reactions
+        ], dtype=np.int8)
+    )
+    logging.info("Wrote the stoichiometry of {:,} compounds in {:,} reactions ({:,} nonzero) to {}".format(
+        len(compounds),
+        len(reactions),
+        matrix.nnz,
+        fp
+    ))
+
+
+# Version of the layout of an exported snapshot
+EXPORT_FORMAT_VERSION = 1
+
+# Columns stored as integers in an export, with every other column stored as text
+EXPORT_INT_COLUMNS = {"direction", "stoichiometry"}
+
+
+def export_table(conn, sql, columns, fp, batch_rows=100000):
+    """Write the rows of a query to a zstd-compressed Parquet file, a batch at a time."""
+    # Only needed for exports, so that a crawl does not depend on pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        (column, pa.int64() if column in EXPORT_INT_COLUMNS else pa.string())
+        for column in columns
+    ])
+    n_rows = 0
+    cursor = conn.execute(sql)
+    with pq.ParquetWriter(fp, schema, compression="zstd") as writer:
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if len(rows) == 0:
+                break
+            writer.write_table(pa.Table.from_arrays(
+                [
+                    pa.array([row[ix] for row in rows], type=schema.field(ix).type)
+                    for ix in range(len(columns))
+                ],
+                schema=schema
             ))
-            try:
-                c.executemany(
-                    """INSERT OR REPLACE INTO reaction_compound
-                        (reaction_id, compound_id, side, stoichiometry)
-                        VALUES (?, ?, ?, ?)
-                    """,
-                    [
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("L"),
-                            sql_safe_string(m.group('stoich'))
-                        ) if m.group('stoich') != None
-                        else
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("L"),
-                            sql_safe_string(str(1))
-                        )
-                        for m in L_compounds
-                    ]+[
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("R"),
-                            sql_safe_string(m.group('stoich'))
-                        ) if m.group('stoich') != None
-                        else
-                        (
-                            sql_safe_string(rxn_id),
-                            sql_safe_string(m.group('compound_id')),
-                            sql_safe_string("R"),
-                            sql_safe_string(str(1))
-                        )
-                        for m in R_compounds
-                    ]
-                )
-                conn.commit()
-            except Exception as e:
-                logging.error("Insertion of reaction-compound failed with exception {}".format(e))
-                assert 1 == 0
-
-    # Now compounds
-    c.execute("select compound_id from compound;")
-    existing_compound_ids = {i[0] for i in c.fetchall()}
-    c.execute("SELECT DISTINCT compound_id from reaction_compound;")
-    linked_compound_ids = {i[0] for i in c.fetchall()}
-    compound_ids_needed = list(linked_compound_ids - existing_compound_ids)
-    compound_ids_needed_c = [c for c in compound_ids_needed if c[0] == 'C']
-    # Also account for glycans
-    compound_ids_needed_g = [c for c in compound_ids_needed if c[0] == 'G']
-    logging.info("We need to download {:,} compounds".format(len(compound_ids_needed)))
-
-    for comp_id_chunk_i, comp_id_chunk in enumerate(chunks(compound_ids_needed_c, chunk_size)):
-        logging.info("Working on compound chunk {:,} of {:,}".format(
-            comp_id_chunk_i + 1,
-            int(len(compound_ids_needed) / chunk_size) + 1
-        ))
-        raw_comp_data = kegg_pool.map(
-            partial(
-                fetch_kegg_api,
-                data_type='cpd'),
-            list(comp_id_chunk)
-            )
-        c.executemany(
-            """INSERT OR REPLACE INTO compound
-                (compound_id, formula)
-                VALUES (?, ?)
-            """,
-            [(comp_id, comp_data.get('FORMULA', [""])[0])
-             for comp_id, comp_data in zip(comp_id_chunk, raw_comp_data)]
+            n_rows += len(rows)
+    return n_rows
+
+
+def export_kegg_snapshot(output_db, export_dir, cache=None, kegg_release=None, bulk_links=False):
+    """Export the KEGG tables (and the raw entries in the cache) as Parquet, with a manifest."""
+    start = time.monotonic()
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+
+    manifest = {
+        "format_version": EXPORT_FORMAT_VERSION,
+        "schema_version": SCHEMA_VERSION,
+        "kegg_release": kegg_release,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        # The orthologs of a --bulk-links build are only in the bulk endpoints
+        "bulk_links": bulk_links,
+        "tables": {},
+    }
+
+    # The queries are specific to each cohort, so only the KEGG tables are exported
+    conn = sqlite3.connect(output_db)
+    for table, columns in MIGRATE_V1:
+        manifest["tables"][table] = export_table(
+            conn,
+            "SELECT {} FROM {};".format(columns, table),
+            columns.split(", "),
+            os.path.join(export_dir, table + ".parquet")
         )
-        c.executemany(
-            """INSERT OR REPLACE INTO compound_name
-            (compound_id, name)
-            VALUES (?,?)
-            """,
-            [(comp_id, name.replace(";", ""))
-                for comp_id, comp_data in zip(comp_id_chunk, raw_comp_data)
-                for name in comp_data['NAME']]
+    conn.close()
+
+    # Raw entries (and the bulk endpoints) can be crawled again (with --snapshot) as the schema changes
+    if cache is not None:
+        manifest["tables"]["raw_entry"] = export_table(
+            cache.conn,
+            "SELECT kegg_key, entry FROM raw_entry;",
+            ["kegg_key", "entry"],
+            os.path.join(export_dir, "raw_entry.parquet")
         )
+
+    with open(os.path.join(export_dir, "manifest.json"), "wt") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+    logging.info("Exported {:,} rows to {} in {:.1f}s".format(
+        sum(manifest["tables"].values()),
+        export_dir,
+        time.monotonic() - start
+    ))
+
+
+def read_export_manifest(export_dir):
+    """Read the manifest of an exported snapshot, checking that this version can load it."""
+    with open(os.path.join(export_dir, "manifest.json"), "rt") as f:
+        manifest = json.load(f)
+    assert manifest.get("format_version") == EXPORT_FORMAT_VERSION, \
+        "Unsupported export format: {}".format(manifest.get("format_version"))
+    assert manifest.get("schema_version") == SCHEMA_VERSION, \
+        "Export has schema version {}, expected {}".format(manifest.get("schema_version"), SCHEMA_VERSION)
+    return manifest
+
+
+def iter_export_rows(fp, batch_rows=100000):
+    """Yield the rows of an exported Parquet file as lists of tuples."""
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(fp).iter_batches(batch_size=batch_rows):
+        yield list(zip(*[column.to_pylist() for column in batch.columns]))
+
+
+def import_kegg_export(conn, export_dir):
+    """Bulk load the KEGG tables of an exported snapshot into the database."""
+    start = time.monotonic()
+    manifest = read_export_manifest(export_dir)
+    logging.info("Importing KEGG release {} exported at {}".format(
+        manifest["kegg_release"],
+        manifest["created_at"]
+    ))
+
+    n_rows = 0
+    for table, columns in MIGRATE_V1:
+        for rows in iter_export_rows(os.path.join(export_dir, table + ".parquet")):
+            conn.executemany(
+                "INSERT OR IGNORE INTO {} ({}) VALUES ({});".format(
+                    table,
+                    columns,
+                    ", ".join(["?"] * len(columns.split(", ")))
+                ),
+                rows
+            )
+            n_rows += len(rows)
         conn.commit()
-    # Glycans
-    for comp_id_chunk_i, comp_id_chunk in enumerate(chunks(compound_ids_needed_g, chunk_size)):
-        logging.info("Working on glycan chunk {:,} of {:,}".format(
-            comp_id_chunk_i + 1,
-            int(len(compound_ids_needed) / chunk_size) + 1
+
+    logging.info("Imported {:,} rows in {:.1f}s".format(n_rows, time.monotonic() - start))
+
+
+def iter_snapshot_files(snapshot):
+    """Yield the name and contents of each file in a snapshot directory or tarball of KEGG flat files."""
+    if os.path.isdir(snapshot):
+        for root, _, fns in os.walk(snapshot):
+            for fn in sorted(fns):
+                with open(os.path.join(root, fn), "rb") as f:
+                    yield os.path.join(root, fn), f.read()
+    else:
+        # Any compression of the tarball is detected from its contents
+        with tarfile.open(snapshot, "r:*") as tar:
+            for member in tar:
+                if member.isfile():
+                    yield member.name, tar.extractfile(member).read()
+
+
+def split_snapshot_file(name, buf):
+    """Split a file of concatenated KEGG entries into their text, keyed as e.g. ko:K00001 (run in a worker)."""
+    if name.endswith(".gz"):
+        buf = gzip.decompress(buf)
+
+    entries = {}
+    for entry_id, entry in kegg_flatfile.split_entries(buf).items():
+        data_type = kegg_flatfile.entry_type(entry_id)
+        if data_type is not None:
+            entries["{}:{}".format(data_type, entry_id)] = entry
+    return entries
+
+
+def import_kegg_snapshot(snapshot, cache, executor, max_in_flight=8):
+    """Load the KEGG entries in a snapshot into the cache, splitting the files in parallel.
+
+    Returns the manifest of a snapshot made with --export-dir, or None for flat files.
+    """
+    start = time.monotonic()
+
+    # The raw entries of an export are loaded as they are
+    if os.path.exists(os.path.join(snapshot, "manifest.json")):
+        manifest = read_export_manifest(snapshot)
+        cache.kegg_release = kegg_release_number(manifest["kegg_release"])
+        if "raw_entry" not in manifest["tables"]:
+            logging.warning("The export in {} has no raw KEGG entries (it was made without --cache-db)".format(snapshot))
+            return manifest
+        n_entries = 0
+        for rows in iter_export_rows(os.path.join(snapshot, "raw_entry.parquet")):
+            cache.put(dict(rows))
+            n_entries += len(rows)
+        logging.info("Imported {:,} KEGG entries (release {}) in {:.1f}s".format(
+            n_entries,
+            manifest["kegg_release"],
+            time.monotonic() - start
         ))
-        raw_comp_data = kegg_pool.map(
-            partial(
-                fetch_kegg_api,
-                data_type='gl'),
-            list(comp_id_chunk)
+        return manifest
+
+    n_files = 0
+    n_entries = defaultdict(int)
+
+    def save(future):
+        entries = future.result()
+        cache.put(entries)
+        for kegg_key in entries:
+            n_entries[kegg_key.split(":", 1)[0]] += 1
+
+    # Only a few files are held in memory at a time
+    in_flight = []
+    for name, buf in iter_snapshot_files(snapshot):
+        n_files += 1
+        in_flight.append(executor.submit(split_snapshot_file, name, buf))
+        if len(in_flight) >= max_in_flight:
+            save(in_flight.pop(0))
+    for future in in_flight:
+        save(future)
+
+    assert sum(n_entries.values()) > 0, "No KEGG entries found in " + snapshot
+    logging.info("Imported {:,} KEGG entries from {:,} files in {:.1f}s ({})".format(
+        sum(n_entries.values()),
+        n_files,
+        time.monotonic() - start,
+        ", ".join([
+            "{:,} {}".format(n, data_type)
+            for data_type, n in sorted(n_entries.items())
+        ])
+    ))
+    return None
+
+
+# Reactions linked from these types of entries have their pathways followed in turn,
+# which limits the crawl to orthologs -> reactions -> pathways -> modules -> reactions
+EXPAND_REACTIONS_FROM = {'ko': True, 'path': False, 'md': False}
+
+
+async def crawl_kegg(
+    kegg,
+    seeds,
+    visited,
+    writer,
+    executor,
+    chunk_size,
+    threads,
+    max_attempts=3,
+    retry_backoff=10
+):
+    """Fetch KEGG entries and every entry they link to, starting from a set of (type, ID, expand) seeds.
+
+    The state of each entry is saved in the crawl_queue table, and entries which could
+    not be fetched are retried (after a delay) up to max_attempts times.
+    """
+    loop = asyncio.get_event_loop()
+
+    # IDs waiting to be fetched, by (type, expand)
+    frontier = defaultdict(list)
+    # Rows for the crawl_queue table which have not been saved yet
+    queued_rows = []
+    # Number of failed attempts at each (type, ID) in this run
+    n_failures = defaultdict(int)
+    n_crawled = 0
+
+    def enqueue(data_type, kegg_id, expand):
+        # Only reactions are parsed differently when expanded, so other entries are fetched once
+        expand = expand and data_type == 'rn'
+        # Entries are only fetched once, unless a reaction now needs its pathways
+        if (data_type, kegg_id) in visited and (visited[(data_type, kegg_id)] or not expand):
+            return
+        visited[(data_type, kegg_id)] = expand
+        frontier[(data_type, expand)].append(kegg_id)
+        queued_rows.append(crawl_state(data_type, kegg_id, expand, "queued"))
+
+    for data_type, kegg_id, expand in seeds:
+        enqueue(data_type, kegg_id, expand)
+
+    n_retry_rounds = 0
+    while True:
+        failed = []
+
+        in_flight = {}
+        while len(frontier) > 0 or len(in_flight) > 0:
+
+            # Entries are saved to the queue before they are fetched
+            if len(queued_rows) > 0:
+                await loop.run_in_executor(None, writer.put, {CRAWL_QUEUE_SQL: queued_rows})
+                queued_rows = []
+
+            # Start on all of the full chunks, and partial chunks when there is spare capacity
+            for (data_type, expand), kegg_ids in list(frontier.items()):
+                while len(kegg_ids) >= chunk_size or (len(kegg_ids) > 0 and len(in_flight) < threads):
+                    task = asyncio.ensure_future(run_kegg_pipeline(
+                        kegg,
+                        kegg_ids[:chunk_size],
+                        data_type,
+                        writer,
+                        executor,
+                        chunk_size,
+                        expand=expand
+                    ))
+                    in_flight[task] = (data_type, expand, len(kegg_ids[:chunk_size]))
+                    del kegg_ids[:chunk_size]
+                if len(kegg_ids) == 0:
+                    del frontier[(data_type, expand)]
+
+            done, _ = await asyncio.wait(list(in_flight), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                data_type, expand, n_ids = in_flight.pop(task)
+                task_neighbors, task_failed = task.result()
+                n_crawled += n_ids - len(task_failed)
+                for kegg_id in task_failed:
+                    n_failures[(data_type, kegg_id)] += 1
+                    failed.append((data_type, kegg_id, expand))
+
+                # Add the entries linked from these entries to the queue
+                for neighbor_type, neighbor_ids in task_neighbors.items():
+                    for neighbor_id in neighbor_ids:
+                        enqueue(
+                            neighbor_type,
+                            neighbor_id,
+                            EXPAND_REACTIONS_FROM.get(data_type, False)
+                        )
+
+            kegg.metrics.log_progress(
+                n_crawled,
+                sum(map(len, frontier.values())) + sum([n_ids for _, _, n_ids in in_flight.values()]),
+                force=len(frontier) == 0 and len(in_flight) == 0
             )
-        c.executemany(
-            """INSERT OR REPLACE INTO compound
-                (compound_id, formula)
-                VALUES (?, ?)
-            """,
-            [(comp_id, comp_data.get('COMPOSITION', [""])[0])
-             for comp_id, comp_data in zip(comp_id_chunk, raw_comp_data)]
-        )
-        c.executemany(
-            """INSERT OR REPLACE INTO compound_name
-            (compound_id, name)
-            VALUES (?,?)
-            """,
-            [(comp_id, name.replace(";", ""))
-                for comp_id, comp_data in zip(comp_id_chunk, raw_comp_data)
-                for name in comp_data['NAME']]
+
+        # Entries which failed are left in the queue for the next run after the last attempt
+        retry = [
+            (data_type, kegg_id, expand)
+            for data_type, kegg_id, expand in failed
+            if n_failures[(data_type, kegg_id)] < max_attempts
+        ]
+        if len(failed) > len(retry):
+            logging.warning("Gave up on {:,} KEGG entries after {:,} attempts, which will be retried by the next run".format(
+                len(failed) - len(retry),
+                max_attempts
+            ))
+        # Without a connection to KEGG, there is no point in trying again
+        if len(retry) == 0 or kegg.offline:
+            break
+
+        delay = retry_backoff * (2 ** n_retry_rounds) * random.uniform(0.5, 1.5)
+        logging.warning("Retrying {:,} failed KEGG entries in {:.1f}s".format(len(retry), delay))
+        await asyncio.sleep(delay)
+        n_retry_rounds += 1
+        for data_type, kegg_id, expand in retry:
+            frontier[(data_type, expand)].append(kegg_id)
+            queued_rows.append(crawl_state(data_type, kegg_id, expand, "retried"))
+
+    return n_crawled
+
+
+def get_kegg_reaction_metadata(
+    input_tsv=None,
+    output_db=None,
+    threads=1,
+    chunk_size=100,
+    parse_workers=2,
+    requests_per_second=3,
+    kegg_url=KEGG_URL,
+    cache_db=None,
+    cache_ttl_days=None,
+    offline=False,
+    bulk_links=False,
+    bulk_load=False,
+    benchmark=False,
+    ingest_batch_size=100000,
+    input_manifest=None,
+    max_attempts=3,
+    snapshot=None,
+    import_dir=None,
+    export_dir=None,
+    stoichiometry_npz=None
+):
+    """Get reaction metadata for the KEGG entries from eggNOG output, write to SQLite."""
+
+    # Entries in a snapshot are loaded into the cache, and then crawled without a network
+    if snapshot is not None:
+        offline = True
+        bulk_load = True
+    metrics = CrawlMetrics()
+    metrics.start_phase("ingest")
+
+    # Make sure the tables exist for orthology, reaction, pathway, and compound
+    conn = sqlite3.connect(output_db)
+    c = conn.cursor()
+    create_schema(c, bulk_load=bulk_load)
+    conn.commit()
+
+    # Entries in an exported snapshot do not need to be fetched
+    if import_dir is not None:
+        import_kegg_export(conn, import_dir)
+
+    # Get the set of KEGG IDs in the input TSV(s), while adding each query to the database
+    if isinstance(input_tsv, str):
+        input_tsv = [input_tsv]
+    input_tsvs = list_input_tsvs(input_tsv, input_manifest=input_manifest)
+
+    if len(input_tsvs) == 1:
+        kegg_ids = insert_query_orthologs(conn, input_tsvs[0], batch_size=ingest_batch_size)
+    else:
+        # Each TSV is read into its own database in parallel, and then merged,
+        # so that the KEGG entries are fetched once for the union of orthologs
+        logging.info("Reading {:,} input TSVs into shards".format(len(input_tsvs)))
+        shard_dbs = [
+            "{}.shard{}".format(output_db, ix)
+            for ix in range(len(input_tsvs))
+        ]
+        kegg_ids = set([])
+        with ProcessPoolExecutor(parse_workers) as ingest_executor:
+            for shard_kegg_ids in ingest_executor.map(
+                ingest_shard,
+                input_tsvs,
+                shard_dbs,
+                [ingest_batch_size] * len(input_tsvs)
+            ):
+                kegg_ids.update(shard_kegg_ids)
+
+        merge_databases(conn, shard_dbs)
+        for shard_db in shard_dbs:
+            os.remove(shard_db)
+
+    logging.info("There are {:,} KEGG IDs in the input TSV".format(len(kegg_ids)))
+
+    # Figure out if we have any existing KEGGS in our db
+    c.execute('select ortholog_id from ortholog;')
+    existing_orthologs = {i[0] for i in c.fetchall()}
+    logging.info("There are {:,} KEGG IDs already in the database".format(
+        len(existing_orthologs)))
+
+    kegg_ids_needed = list(kegg_ids - existing_orthologs)
+    logging.info("There are {:,} KEGG IDs we need to download".format(
+        len(kegg_ids_needed)))
+
+    # Begin downloading from KEGG
+    kegg = KeggClient(
+        kegg_url=kegg_url,
+        threads=threads,
+        requests_per_second=requests_per_second,
+        offline=offline,
+        metrics=metrics
+    )
+
+    # Reuse the entries downloaded by earlier runs
+    kegg_release = None
+    if cache_db is not None:
+        if offline:
+            kegg_release = None
+        else:
+            kegg_release = kegg.get_release()
+            logging.info("KEGG release: " + kegg_release)
+        kegg.cache = KeggCache(
+            cache_db,
+            ttl_days=cache_ttl_days,
+            kegg_release=kegg_release
         )
+
+    # Entries are parsed in worker processes, and inserted by a single thread
+    executor = ProcessPoolExecutor(parse_workers)
+    writer = SQLiteWriter(output_db, bulk_load=bulk_load, metrics=metrics)
+
+    if snapshot is not None:
+        snapshot_manifest = import_kegg_snapshot(snapshot, kegg.cache, executor, max_in_flight=2 * parse_workers)
+        if snapshot_manifest is not None:
+            # Without raw entries, the exported tables are loaded as they are
+            if "raw_entry" not in snapshot_manifest["tables"]:
+                import_kegg_export(conn, snapshot)
+            # The orthologs of a --bulk-links build can only be rebuilt from the bulk endpoints
+            if snapshot_manifest.get("bulk_links") and not bulk_links:
+                logging.info("The snapshot was made with --bulk-links, which is used to rebuild it")
+                bulk_links = True
+
+    # Entries already in the database are not fetched again
+    visited = {}
+    for data_type, sql in [
+        ('ko', "SELECT ortholog_id FROM ortholog;"),
+        ('rn', "SELECT reaction_id FROM reaction;"),
+        ('path', "SELECT pathway_id FROM pathway;"),
+        ('md', "SELECT module_id FROM module;"),
+        ('cpd', "SELECT compound_id FROM compound WHERE compound_id LIKE 'C%';"),
+        ('gl', "SELECT compound_id FROM compound WHERE compound_id LIKE 'G%';"),
+    ]:
+        c.execute(sql)
+        visited.update({(data_type, i[0]): True for i in c.fetchall()})
+
+    # Entries which an earlier run found were not in KEGG are not fetched again either
+    c.execute("SELECT data_type, kegg_id, expand FROM crawl_queue WHERE state = 'fetched';")
+    for data_type, kegg_id, expand in c.fetchall():
+        visited[(data_type, kegg_id)] = visited.get((data_type, kegg_id), False) or bool(expand)
+
+    # Start from the orthologs in the input, along with any entries linked
+    # to in the database which were not yet fetched by an earlier run
+    seeds = [('ko', kegg_id, True) for kegg_id in kegg_ids_needed]
+
+    # Resume the entries left in the queue by an interrupted or failed run
+    c.execute("SELECT data_type, kegg_id, expand FROM crawl_queue WHERE state != 'fetched';")
+    resumed = [(data_type, kegg_id, bool(expand)) for data_type, kegg_id, expand in c.fetchall()]
+    if len(resumed) > 0:
+        logging.info("Resuming {:,} KEGG entries left in the crawl queue".format(len(resumed)))
+    seeds.extend(resumed)
+    for data_type, expand, sql in [
+        ('rn', True, "SELECT DISTINCT reaction_id FROM ortholog_has_reaction;"),
+        ('path', False, "SELECT DISTINCT pathway_id FROM pathway_reaction;"),
+        ('md', False, "SELECT DISTINCT module_id FROM module_pathway;"),
+        ('rn', False, "SELECT DISTINCT reaction_id FROM pathway_reaction;"),
+        ('rn', False, "SELECT DISTINCT reaction_id FROM module_reaction;"),
+        ('cpd', False, "SELECT DISTINCT compound_id FROM reaction_compound WHERE compound_id LIKE 'C%';"),
+        ('gl', False, "SELECT DISTINCT compound_id FROM reaction_compound WHERE compound_id LIKE 'G%';"),
+    ]:
+        c.execute(sql)
+        seeds.extend([(data_type, i[0], expand) for i in c.fetchall()])
+
+    # Fill in the orthologs and links from the bulk endpoints, instead of each entry
+    metrics.start_phase("crawl")
+    if bulk_links:
+        logging.info("Downloading links from the bulk KEGG endpoints")
+        bulk_inserts, bulk_seeds = kegg.loop.run_until_complete(fetch_kegg_bulk(
+            kegg,
+            kegg_ids_needed
+        ))
+        writer.put(bulk_inserts)
+        seeds = [seed for seed in seeds if seed[0] != 'ko'] + bulk_seeds
+
+    logging.info("Starting download of KEGG data")
+    n_crawled = kegg.loop.run_until_complete(crawl_kegg(
+        kegg,
+        seeds,
+        visited,
+        writer,
+        executor,
+        chunk_size,
+        threads,
+        max_attempts=max_attempts
+    ))
+    writer.flush()
+    logging.info("Downloaded {:,} KEGG entries".format(n_crawled))
+
+    writer.close()
+    executor.shutdown()
+    if bulk_load:
+        metrics.start_phase("index")
+        logging.info("Creating indexes")
+        create_indexes(c)
         conn.commit()
+    metrics.start_phase(None)
+
+    if benchmark:
+        benchmark_queries(c)
 
+    if stoichiometry_npz is not None:
+        write_stoichiometry_matrix(conn, stoichiometry_npz)
+
+    if export_dir is not None:
+        # The full release (for information) is known from KEGG, or else the number from
+        # the cache (or a snapshot loaded into it), or asked of KEGG
+        if kegg_release is None and kegg.cache is not None:
+            kegg_release = kegg.cache.kegg_release
+        if kegg_release is None and not offline:
+            kegg_release = kegg.get_release()
+        export_kegg_snapshot(
+            output_db,
+            export_dir,
+            cache=kegg.cache,
+            kegg_release=kegg_release,
+            bulk_links=bulk_links
+        )
+
+    kegg.log_stats()
+    kegg.close()
+    if kegg.cache is not None:
+        kegg.cache.log_stats()
+        metrics.count("cache", "hits", kegg.cache.hits)
+        metrics.count("cache", "misses", kegg.cache.misses)
+        kegg.cache.close()
     conn.close()
 
+    # Summary of the build, for tuning --threads, --chunk-size etc.
+    metrics.write_json(
+        output_db + ".metrics.json",
+        threads=threads,
+        chunk_size=chunk_size,
+        parse_workers=parse_workers,
+        requests_per_second=requests_per_second,
+        bulk_links=bulk_links,
+        bulk_load=bulk_load,
+        n_input_orthologs=len(kegg_ids),
+        n_crawled=n_crawled
+    )
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="""
@@ -748,16 +1921,89 @@ if __name__ == "__main__":
 
     parser.add_argument("--input-tsv",
                         type=str,
-                        required=True,
-                        help="""Location for local input path.""")
+                        nargs="+",
+                        default=[],
+                        help="""Location for input path(s), which may be globs.
+                                (Supported: s3://, or local path; TSV, optionally .gz or .zst, or Parquet).
+                                Multiple TSVs are read in parallel and merged.""")
+    parser.add_argument("--input-manifest",
+                        type=str,
+                        help="""File listing input TSV paths, one per line.
+                                (Supported: s3://, or local path).""")
     parser.add_argument("--threads",
                         type=int,
                         default=1,
                         help="""Number of concurrent calls to KEGG""")
+    parser.add_argument("--requests-per-second",
+                        type=float,
+                        default=3,
+                        help="""Maximum rate of calls to KEGG""")
+    parser.add_argument("--kegg-url",
+                        type=str,
+                        default=KEGG_URL,
+                        help="""Base URL for the KEGG API""")
+    parser.add_argument("--max-attempts",
+                        type=int,
+                        default=3,
+                        help="""Number of times to try fetching a KEGG entry before leaving it in the
+                                crawl queue for the next run""")
+    parser.add_argument("--cache-db",
+                        type=str,
+                        default=None,
+                        help="""SQLite database used to cache KEGG entries across runs,
+                                until the release number of KEGG changes.""")
+    parser.add_argument("--cache-ttl-days",
+                        type=float,
+                        default=None,
+                        help="""Refetch cached KEGG entries older than this many days.""")
+    parser.add_argument("--offline",
+                        action="store_true",
+                        help="""Only use KEGG entries from --cache-db, without connecting to KEGG.""")
+    parser.add_argument("--snapshot",
+                        type=str,
+                        default=None,
+                        help="""Directory or tarball of KEGG flat files (or a directory made with
+                                --export-dir) to load into --cache-db,
+                                building the database from them without connecting to KEGG
+                                (implies --offline and --bulk-load).""")
+    parser.add_argument("--import-dir",
+                        type=str,
+                        default=None,
+                        help="""Load the tables of a snapshot made with --export-dir before crawling.""")
+    parser.add_argument("--export-dir",
+                        type=str,
+                        default=None,
+                        help="""Export the KEGG tables (and the raw entries in --cache-db) as
+                                zstd-compressed Parquet files with a manifest, once the database is built.""")
+    parser.add_argument("--stoichiometry-npz",
+                        type=str,
+                        default=None,
+                        help="""Save the sparse compound x reaction stoichiometric matrix (and the
+                                direction of each reaction) for the reactions of the query orthologs.""")
+    parser.add_argument("--bulk-links",
+                        action="store_true",
+                        help="""Get orthologs and the links between entries from the bulk KEGG
+                                link/list endpoints, fetching single entries only for reactions,
+                                pathways, modules and compounds.""")
+    parser.add_argument("--bulk-load",
+                        action="store_true",
+                        help="""Load the database in a few large transactions with WAL and
+                                synchronous=OFF, creating indexes at the end.""")
+    parser.add_argument("--benchmark",
+                        action="store_true",
+                        help="""Time the common queries through the database once it is built.""")
     parser.add_argument("--chunk-size",
                         type=int,
                         default=100,
-                        help="""Number of KEGG ids to work on at a time""")
+                        help="""Number of KEGG entries to parse at a time""")
+    parser.add_argument("--ingest-batch-size",
+                        type=int,
+                        default=100000,
+                        help="""Number of query orthologs to read from the TSV at a time""")
+    parser.add_argument("--parse-workers",
+                        type=int,
+                        default=2,
+                        help="""Number of processes used to parse KEGG entries""")
     parser.add_argument("--output-db",
                         type=str,
                         required=True,
@@ -765,4 +2011,23 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
+    # Set up logging, which is left alone when this is imported (e.g. by the parse workers)
+    logFormatter = logging.Formatter(
+        '%(asctime)s %(levelname)-8s [kegg_reaction_metadata] %(message)s'
+    )
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    # Also write to STDOUT
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+
+    # Offline runs need a cache to read from
+    assert args.cache_db is not None or not args.offline, "--offline requires --cache-db"
+    assert args.cache_db is not None or args.snapshot is None, "--snapshot requires --cache-db"
+
+    assert len(args.input_tsv) > 0 or args.input_manifest is not None, \
+        "Provide --input-tsv and/or --input-manifest"
+
     get_kegg_reaction_metadata(**args.__dict__)
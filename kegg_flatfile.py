@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""Parse KEGG flat-file entries into compact records, in a single pass over each entry."""
+
+import argparse
+import sqlite3
+import time
+import re
+from collections import namedtuple
+
+# Each line of an entry has a 12 character label, which is blank when continuing a field
+LABEL_WIDTH = 12
+
+# Terms of an equation, e.g. '2 C00001' or 'G10526'
+RE_COMPOUND = re.compile(r'((?P<stoich>\d+)\s+|)(?P<compound_id>(?P<type>G|C)\d+)')
+
+Ortholog = namedtuple("Ortholog", ["ortholog_id", "name", "definition", "reactions"])
+# Compounds are (compound_id, side, stoichiometry), and direction is None without an equation
+Reaction = namedtuple("Reaction", [
+    "reaction_id", "definition", "equation", "enzyme", "direction", "pathways", "compounds"
+])
+Pathway = namedtuple("Pathway", [
+    "pathway_id", "name", "pathway_class", "description", "reactions", "compounds", "modules"
+])
+Module = namedtuple("Module", ["module_id", "name", "module_class", "compounds", "reactions"])
+Compound = namedtuple("Compound", ["compound_id", "formula", "names"])
+
+
+def iter_fields(entry):
+    """Yield the (label, value) of each line of an entry, as bytes or text."""
+    if isinstance(entry, bytes):
+        entry = entry.decode("utf-8")
+
+    label = None
+    for line in entry.split("\n"):
+        if len(line) == 0 or line.startswith("///"):
+            continue
+        line_label = line[:LABEL_WIDTH].strip(" ")
+        if len(line_label) > 0:
+            label = line_label
+        yield label, line[LABEL_WIDTH:]
+
+
+def read_fields(entry, first, every):
+    """Read the first line of the fields in `first`, and all of the lines of those in `every`."""
+    values = {}
+    lists = {field: [] for field in every}
+    for label, value in iter_fields(entry):
+        if label in lists:
+            lists[label].append(value)
+        if label in first and label not in values:
+            values[label] = value
+    return values, lists
+
+
+def first_word(value):
+    return value.split(" ", 1)[0].strip()
+
+
+def word_list(values):
+    """IDs listed as 'R00001,R00002 description', one line at a time."""
+    return [
+        kegg_id
+        for value in values
+        for kegg_id in value.split(" ")[0].split(",")
+    ]
+
+
+def parse_equation(equation):
+    """Return the direction of a reaction and its compounds, or (None, []) without an equation."""
+    if "=" not in equation:
+        return None, []
+
+    e_L, e_R = equation.split("=", 1)
+    # 2 is reversible, 1 is right to left, 0 is left to right
+    if e_L[-1] == "<" and e_R[0] == ">":
+        direction = 2
+    elif e_L[-1] == "<":
+        direction = 1
+    elif e_R[0] == ">":
+        direction = 0
+    else:
+        direction = -1
+
+    compounds = []
+    for side, terms in [("L", e_L[:-1]), ("R", e_R[1:])]:
+        for term in terms.split(" + "):
+            m = RE_COMPOUND.search(term.strip())
+            if m is None:
+                continue
+            compounds.append((
+                m.group("compound_id"),
+                side,
+                m.group("stoich") if m.group("stoich") is not None else str(1)
+            ))
+    return direction, compounds
+
+
+def parse_ortholog(kegg_id, entry):
+    values, lists = read_fields(entry, ("NAME", "DEFINITION"), ("DBLINKS", ))
+    reactions = set()
+    for dblink in lists["DBLINKS"]:
+        if dblink.startswith("RN: "):
+            reactions.update(dblink[4:].split(" "))
+    return Ortholog(
+        kegg_id,
+        values.get("NAME", ""),
+        values.get("DEFINITION", ""),
+        tuple(reactions)
+    )
+
+
+def parse_reaction(kegg_id, entry):
+    values, lists = read_fields(entry, ("DEFINITION", "EQUATION", "ENZYME"), ("PATHWAY", ))
+    equation = values.get("EQUATION", "")
+    direction, compounds = parse_equation(equation)
+    return Reaction(
+        kegg_id,
+        values.get("DEFINITION", ""),
+        equation,
+        values.get("ENZYME", ""),
+        direction,
+        tuple(value.split(" ", 1)[0] for value in lists["PATHWAY"]),
+        tuple(compounds)
+    )
+
+
+def parse_pathway(kegg_id, entry):
+    values, lists = read_fields(
+        entry,
+        ("NAME", "CLASS", "DESCRIPTION"),
+        ("REACTION", "COMPOUND", "MODULE")
+    )
+    return Pathway(
+        kegg_id,
+        values.get("NAME", ""),
+        values.get("CLASS", ""),
+        values.get("DESCRIPTION", ""),
+        tuple(word_list(lists["REACTION"])),
+        tuple(map(first_word, lists["COMPOUND"])),
+        tuple(map(first_word, lists["MODULE"]))
+    )
+
+
+def parse_module(kegg_id, entry):
+    values, lists = read_fields(entry, ("NAME", "CLASS"), ("COMPOUND", "REACTION"))
+    return Module(
+        kegg_id,
+        values.get("NAME", ""),
+        values.get("CLASS", ""),
+        tuple(map(first_word, lists["COMPOUND"])),
+        tuple(word_list(lists["REACTION"]))
+    )
+
+
+def parse_compound(kegg_id, entry):
+    values, lists = read_fields(entry, ("FORMULA", "COMPOSITION"), ("NAME", ))
+    # Glycans have a composition instead of a formula
+    if kegg_id[0] == "G":
+        formula = values.get("COMPOSITION", "")
+    else:
+        formula = values.get("FORMULA", "")
+    return Compound(
+        kegg_id,
+        formula,
+        tuple(name.replace(";", "") for name in lists["NAME"])
+    )
+
+
+# Parser for each type of KEGG entry
+PARSERS = {
+    "ko": parse_ortholog,
+    "rn": parse_reaction,
+    "path": parse_pathway,
+    "md": parse_module,
+    "cpd": parse_compound,
+    "gl": parse_compound,
+}
+
+
+def parse_entry(data_type, kegg_id, entry):
+    """Parse the text of a single entry (or None for a missing entry) into a record."""
+    return PARSERS[data_type](kegg_id, entry or "")
+
+
+# Type of each entry, from the format of its ID
+ENTRY_ID_TYPES = [
+    (re.compile(r"^K\d{5}$"), "ko"),
+    (re.compile(r"^R\d{5}$"), "rn"),
+    (re.compile(r"^rn\d{5}$"), "path"),
+    (re.compile(r"^M\d{5}$"), "md"),
+    (re.compile(r"^C\d{5}$"), "cpd"),
+    (re.compile(r"^G\d{5}$"), "gl"),
+]
+
+
+def entry_type(entry_id):
+    """Return the type of an entry (e.g. 'ko' for K00001), or None if it is not used here."""
+    for pattern, data_type in ENTRY_ID_TYPES:
+        if pattern.match(entry_id):
+            return data_type
+    return None
+
+
+def split_entries(buf):
+    """Split a buffer of concatenated entries into the text of each entry, keyed by ID."""
+    if isinstance(buf, bytes):
+        buf = buf.decode("utf-8")
+
+    # Entries each end with '///'
+    entries = {}
+    entry_lines = []
+    for line in buf.split("\n"):
+        if line.startswith("///"):
+            entry_lines.append(line)
+            # The first word of the ENTRY field is the ID
+            entry_id = entry_lines[0][LABEL_WIDTH:].split(" ", 1)[0]
+            entries[entry_id] = "\n".join(entry_lines) + "\n"
+            entry_lines = []
+        elif len(line) > 0:
+            entry_lines.append(line)
+
+    return entries
+
+
+def read_cache_entries(cache_db):
+    """(data_type, kegg_id, entry) of every entry recorded in a cache made by get_kegg_reaction_metadata.py."""
+    conn = sqlite3.connect(cache_db)
+    entries = [
+        (kegg_key.split(":", 1)[0], kegg_key.split(":", 1)[1], entry)
+        for kegg_key, entry in conn.execute(
+            "SELECT kegg_key, entry FROM raw_entry WHERE entry IS NOT NULL;"
+        )
+        if kegg_key.split(":", 1)[0] in PARSERS
+    ]
+    conn.close()
+    return entries
+
+
+def read_flatfile_entries(fp):
+    """(data_type, kegg_id, entry) of every entry in a file of concatenated flat-file entries."""
+    with open(fp, "rb") as f:
+        entries = split_entries(f.read())
+    return [
+        (entry_type(entry_id), entry_id, entry)
+        for entry_id, entry in entries.items()
+        if entry_type(entry_id) is not None
+    ]
+
+
+def benchmark(entries, repeats=3):
+    """Time the parser over a list of (data_type, kegg_id, entry)."""
+    assert len(entries) > 0, "No entries to parse"
+
+    n_bytes = sum([len(entry) for _, _, entry in entries])
+    timings = []
+    for _ in range(repeats):
+        start = time.monotonic()
+        for data_type, kegg_id, entry in entries:
+            parse_entry(data_type, kegg_id, entry)
+        timings.append(time.monotonic() - start)
+
+    print("Parsed {:,} entries ({:,} bytes) in {:.4f}s, {:,.0f} entries/s (best of {})".format(
+        len(entries),
+        n_bytes,
+        min(timings),
+        len(entries) / max(min(timings), 1e-9),
+        repeats
+    ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="""
+    Benchmark the KEGG flat-file parser over the entries recorded in a cache database,
+    or in a file of concatenated entries.
+    """)
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--cache-db",
+                        type=str,
+                        help="""Cache made with get_kegg_reaction_metadata.py --cache-db""")
+    source.add_argument("--entries",
+                        type=str,
+                        help="""File of flat-file entries, as returned by the KEGG /get endpoint""")
+    parser.add_argument("--repeats",
+                        type=int,
+                        default=3,
+                        help="""Number of times to parse every entry""")
+
+    args = parser.parse_args()
+
+    if args.cache_db is not None:
+        entries = read_cache_entries(args.cache_db)
+    else:
+        entries = read_flatfile_entries(args.entries)
+
+    benchmark(entries, repeats=args.repeats)
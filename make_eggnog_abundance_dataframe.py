@@ -2,21 +2,30 @@
 """Join together a set of results based on their eggNOG annotations."""
 
 import os
-import io
 import sys
 import uuid
 import copy
 import time
 import gzip
 import json
-import boto3
+import hashlib
 import shutil
 import logging
 import argparse
 import traceback
-import numpy as np
-import pandas as pd
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import storage
+import eggnog_table
+
+
+# Column of the eggNOG mapper output holding each type of annotation
+ANNOT_COLUMNS = {
+    "eggNOG": "seed_eggNOG_ortholog",
+    "KO": "KEGG_KOs",
+    "GO": "GO_terms",
+}
 
 
 def exit_and_clean_up(temp_folder):
@@ -37,120 +46,192 @@ def exit_and_clean_up(temp_folder):
     sys.exit(exc_value)
 
 
+def map_threads(func, items, threads):
+    """Apply a function to each item, using a pool of threads if more than one is requested."""
+    if threads <= 1:
+        return [func(i) for i in items]
+
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
 def read_json(fp):
     assert fp.endswith((".json", ".json.gz"))
     logging.info("Reading in " + fp)
-    if fp.startswith("s3://"):
-        # Parse the S3 bucket and key
-        bucket_name, key_name = fp[5:].split("/", 1)
+    with storage.open_read(fp, "rt") as f:
+        dat = json.load(f)
 
-        # Connect to the S3 boto3 client
-        s3 = boto3.client('s3')
+    # Make sure that the sample sheet is a dictionary
+    assert isinstance(dat, dict)
 
-        # Download the object
-        retr = s3.get_object(Bucket=bucket_name, Key=key_name)
+    return dat
 
-        if fp.endswith(".gz"):
-            # Parse GZIP
-            bytestream = io.BytesIO(retr['Body'].read())
-            got_text = gzip.GzipFile(
-                None, 'rb', fileobj=bytestream).read().decode('utf-8')
-        else:
-            # Read text
-            got_text = retr['Body'].read().decode('utf-8')
 
-        # Parse the JSON
-        dat = json.loads(got_text)
+def hash_eggnog_annot(eggnog_annot):
+    """Fingerprint the grouping of genes into eggNOG annotations."""
+    sha = hashlib.sha256()
+    for eggnog_id in sorted(eggnog_annot.keys()):
+        sha.update(eggnog_id.encode("utf-8"))
+        sha.update(b"\t")
+        sha.update(",".join(sorted(eggnog_annot[eggnog_id])).encode("utf-8"))
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+def digest_eggnog_annot(eggnog_annot):
+    """Short fingerprint of the set of genes in each eggNOG annotation, keyed by annotation."""
+    return {
+        eggnog_id: hashlib.sha256(
+            ",".join(sorted(gene_ids)).encode("utf-8")
+        ).hexdigest()[:16]
+        for eggnog_id, gene_ids in eggnog_annot.items()
+    }
 
-    else:
-        assert os.path.exists(fp)
 
-        if fp.endswith(".gz"):
-            dat = json.load(gzip.open(fp, "rt"))
-        else:
-            dat = json.load(open(fp, "rt"))
+def read_sample_proportions(eggnog_annot, sample_name, sample_path, results_key, abundance_key, gene_id_key):
+    """Calculate the proportion of a single sample assigned to each eggNOG annotation."""
+    import numpy as np
+    import pandas as pd
 
-    # Make sure that the sample sheet is a dictionary
-    assert isinstance(dat, dict)
+    # Get the JSON for this particular sample
+    sample_dat = read_json(sample_path)
 
-    return dat
+    # Make sure that the key for the results is in this file
+    assert results_key in sample_dat
 
+    # Subset down to the list of results
+    sample_dat = sample_dat[results_key]
+    assert isinstance(sample_dat, list)
 
-def parse_gzipped_tsv(fp):
-    assert fp.endswith(".tsv.gz")
-    logging.info("Reading in " + fp)
-    if fp.startswith("s3://"):
-        # Parse the S3 bucket and key
-        bucket_name, key_name = fp[5:].split("/", 1)
+    # Make sure that every element in the list has the indicated keys
+    for d in sample_dat:
+        assert abundance_key in d
+        assert gene_id_key in d
 
-        # Connect to the S3 boto3 client
-        s3 = boto3.client('s3')
+    # Format as a Series
+    depth = pd.Series({
+        d[gene_id_key]: d[abundance_key]
+        for d in sample_dat
+    })
 
-        # Download the object
-        retr = s3.get_object(Bucket=bucket_name, Key=key_name)
+    # Sum up the depths by eggNOG annotations
+    eggnog_depth = pd.Series({
+        eggnog_id: np.sum([depth.get(gene_id, 0) for gene_id in list(gene_id_list)])
+        for eggnog_id, gene_id_list in eggnog_annot.items()
+    })
 
-        # Parse GZIP
-        bytestream = io.BytesIO(retr['Body'].read())
-        got_text = gzip.GzipFile(
-            None, 'rb', fileobj=bytestream).read().decode('utf-8')
+    # Remove the eggNOG annots with zero depth
+    eggnog_depth = eggnog_depth.loc[eggnog_depth > 0]
+    logging.info("Read in {:,} eggNOG annotations for {}".format(
+        eggnog_depth.shape[0],
+        sample_name
+    ))
 
-        dat = got_text.split("\n")
+    # Save the proportion of the total sample assigned to each annotation
+    return eggnog_depth / depth.sum()
 
-    else:
-        assert os.path.exists(fp)
 
-        dat = gzip.open(fp, "rt").readlines()
+def make_cache_key(etag, annot_fingerprint, eggnog_annot_field, results_key, abundance_key, gene_id_key):
+    """Key for the cached proportions of a single sample, given all of the inputs used to compute them."""
+    return hashlib.sha256(json.dumps([
+        etag,
+        annot_fingerprint,
+        eggnog_annot_field,
+        results_key,
+        abundance_key,
+        gene_id_key
+    ]).encode("utf-8")).hexdigest()
 
-    for line in dat:
-        if len(line) == 0 or line[0] == '#':
-            continue
-        yield line.split("\t")
 
+def read_cached_proportions(cache_folder, cache_key):
+    """Read the proportions for a single sample from the cache, returning None if absent."""
+    import pandas as pd
+
+    fp = cache_folder.rstrip("/") + "/" + cache_key + ".json.gz"
+    if not storage.exists(fp):
+        return None
+
+    with storage.open_read(fp, "rt") as f:
+        dat = json.load(f)
+
+    return pd.Series(dat, dtype=float)
 
-def read_eggnog_proportion_df(eggnog_annot, sample_sheet, results_key, abundance_key, gene_id_key):
+
+def write_cached_proportions(cache_folder, cache_key, proportions):
+    """Write the proportions for a single sample to the cache."""
+    fp = cache_folder.rstrip("/") + "/" + cache_key + ".json.gz"
+
+    # Local files are written under a temporary name first, so that partial files are never read
+    with storage.open_write(fp) as f:
+        f.write(json.dumps(proportions.to_dict()).encode("utf-8"))
+
+
+def read_eggnog_proportion_df(
+    eggnog_annot,
+    sample_sheet,
+    results_key,
+    abundance_key,
+    gene_id_key,
+    cache_folder=None,
+    cache_keys=None,
+    threads=1
+):
     """Make a single DataFrame with the abundance (depth) from all samples for each eggNOG annotation."""
+    import pandas as pd
+
+    def process_sample(sample):
+        sample_name, sample_path = sample
+
+        # Check to see if the proportions were already computed
+        if cache_folder is not None:
+            proportions = read_cached_proportions(
+                cache_folder,
+                cache_keys[sample_name]
+            )
+            if proportions is not None:
+                logging.info("Read in {:,} eggNOG annotations for {} from the cache".format(
+                    proportions.shape[0],
+                    sample_name
+                ))
+                return proportions, True
+
+        proportions = read_sample_proportions(
+            eggnog_annot,
+            sample_name,
+            sample_path,
+            results_key,
+            abundance_key,
+            gene_id_key
+        )
+
+        if cache_folder is not None:
+            write_cached_proportions(
+                cache_folder,
+                cache_keys[sample_name],
+                proportions
+            )
+
+        return proportions, False
+
+    # Process each sample, using multiple threads to overlap reads from S3
+    samples = list(sample_sheet.items())
+    results = map_threads(process_sample, samples, threads)
 
     # Collect all of the abundance information in this single dict
-    dat = {}
-
-    # Iterate over each sample
-    for sample_name, sample_path in sample_sheet.items():
-        # Get the JSON for this particular sample
-        sample_dat = read_json(sample_path)
-
-        # Make sure that the key for the results is in this file
-        assert results_key in sample_dat
-
-        # Subset down to the list of results
-        sample_dat = sample_dat[results_key]
-        assert isinstance(sample_dat, list)
-
-        # Make sure that every element in the list has the indicated keys
-        for d in sample_dat:
-            assert abundance_key in d
-            assert gene_id_key in d
-
-        # Format as a Series
-        depth = pd.Series({
-            d[gene_id_key]: d[abundance_key]
-            for d in sample_dat
-        })
-
-        # Sum up the depths by eggNOG annotations
-        eggnog_depth = pd.Series({
-            eggnog_id: np.sum([depth.get(gene_id, 0) for gene_id in list(gene_id_list)])
-            for eggnog_id, gene_id_list in eggnog_annot.items()
-        })
-
-        # Remove the eggNOG annots with zero depth
-        eggnog_depth = eggnog_depth.loc[eggnog_depth > 0]
-        logging.info("Read in {:,} eggNOG annotations for {}".format(
-            eggnog_depth.shape[0],
-            sample_name
-        ))
+    dat = {
+        str(sample_name): proportions
+        for (sample_name, _), (proportions, _) in zip(samples, results)
+    }
 
-        # Save the proportion of the total sample assigned to each annotation
-        dat[str(sample_name)] = eggnog_depth / depth.sum()
+    if cache_folder is not None:
+        cache_hits = sum([cache_hit for _, cache_hit in results])
+        logging.info("Sample cache: {:,} hits, {:,} misses".format(
+            cache_hits,
+            len(results) - cache_hits
+        ))
 
     logging.info("Formatting as a DataFrame")
     dat = pd.DataFrame(dat).fillna(0)
@@ -163,84 +244,198 @@ def read_eggnog_proportion_df(eggnog_annot, sample_sheet, results_key, abundance
     return dat
 
 
-def return_results(df, log_fp, output_prefix, output_folder, temp_folder):
-    """Write out all of the results to a file and copy to a final output directory"""
+def update_eggnog_proportion_df(
+    existing_df,
+    manifest,
+    eggnog_annot,
+    annot_fingerprint,
+    annot_digests,
+    sample_sheet,
+    sample_etags,
+    results_key,
+    abundance_key,
+    gene_id_key,
+    cache_folder=None,
+    cache_keys=None,
+    threads=1
+):
+    """Add new or changed samples to an existing DataFrame of eggNOG abundances.
+
+    Existing samples are kept as long as the genes in each of their annotations are the same,
+    which is the case when annotations have only been added (e.g. from a new annotation file).
+    """
+    import pandas as pd
+
+    # The proportions of existing samples change if any annotation gained or lost genes
+    existing_digests = manifest.get("annotation_digests")
+    if manifest.get("annotation_index") == annot_fingerprint:
+        rebuild = False
+    elif existing_digests is None:
+        logging.info("eggNOG annotations differ from the existing table, whose manifest does not record each annotation, so all samples are processed again")
+        rebuild = True
+    else:
+        changed = [
+            eggnog_id
+            for eggnog_id, digest in existing_digests.items()
+            if annot_digests.get(eggnog_id) != digest
+        ]
+        added = [
+            eggnog_id
+            for eggnog_id in annot_digests
+            if eggnog_id not in existing_digests
+        ]
+        if len(changed) > 0:
+            logging.info("{:,} eggNOG annotations have different genes than in the existing table (or were removed), so all samples are processed again".format(
+                len(changed)
+            ))
+            rebuild = True
+        else:
+            logging.info("{:,} eggNOG annotations were added since the existing table, which are only counted for new or changed samples".format(
+                len(added)
+            ))
+            rebuild = False
+
+    if rebuild:
+        return read_eggnog_proportion_df(
+            eggnog_annot,
+            sample_sheet,
+            results_key,
+            abundance_key,
+            gene_id_key,
+            cache_folder=cache_folder,
+            cache_keys=cache_keys,
+            threads=threads
+        )
+
+    # Figure out which samples can be kept from the existing table
+    processed_samples = manifest.get("samples", {})
+    unchanged_samples = [
+        str(sample_name)
+        for sample_name, sample_path in sample_sheet.items()
+        if str(sample_name) in existing_df.columns and
+        processed_samples.get(str(sample_name)) == {
+            "path": sample_path,
+            "etag": sample_etags[sample_name]
+        }
+    ]
+    samples_to_process = {
+        sample_name: sample_path
+        for sample_name, sample_path in sample_sheet.items()
+        if str(sample_name) not in unchanged_samples
+    }
+    logging.info("Keeping {:,} unchanged samples, processing {:,} new or changed samples".format(
+        len(unchanged_samples),
+        len(samples_to_process)
+    ))
+
+    df = existing_df.reindex(columns=unchanged_samples)
+
+    if len(samples_to_process) > 0:
+        new_df = read_eggnog_proportion_df(
+            eggnog_annot,
+            samples_to_process,
+            results_key,
+            abundance_key,
+            gene_id_key,
+            cache_folder=cache_folder,
+            cache_keys=cache_keys,
+            threads=threads
+        )
+
+        # Widen the set of annotations to cover both tables
+        df = pd.concat([df, new_df], axis=1, sort=False).fillna(0)
+
+    # Order the samples as they appear in the sample sheet
+    df = df.reindex(columns=[str(sample_name) for sample_name in sample_sheet])
+
+    # Remove any annotations which are no longer found in any sample
+    df = df.loc[(df > 0).any(axis=1)]
+
+    logging.info("Updated table has {:,} eggNOG annotations across {:,} samples".format(
+        df.shape[0],
+        df.shape[1]
+    ))
+
+    return df
+
+
+def write_output(obj, suffix, f):
+    """Write a single output object to an open binary file."""
+    if suffix.endswith(".feather"):
+        obj.reset_index().to_feather(f)
+    elif suffix.endswith(".parquet"):
+        obj.reset_index().to_parquet(f)
+    elif suffix.endswith(".json.gz"):
+        with gzip.GzipFile(None, 'wb', fileobj=f) as gzf:
+            gzf.write(json.dumps(obj).encode("utf-8"))
+    elif suffix.endswith(".json"):
+        f.write(json.dumps(obj, indent=2).encode("utf-8"))
+    elif suffix.endswith(".txt"):
+        # Text outputs are copied from an existing file
+        with open(obj, "rb") as f_in:
+            shutil.copyfileobj(f_in, f)
+    else:
+        raise Exception(
+            "Object cannot be written, no method for " + suffix)
+
+
+def return_results(df, log_fp, output_prefix, output_folder, temp_folder, manifest=None, output_format="feather"):
+    """Write out all of the results directly to the final output directory"""
 
     # Make sure the output folder ends with a '/'
     if output_folder.endswith("/") is False:
         output_folder = output_folder + "/"
 
-    if output_folder.startswith("s3://"):
-        s3 = boto3.resource('s3')
-
     for suffix, obj in [
-        (".feather", df),
+        ("." + output_format, df),
+        (".manifest.json", manifest),
         (".logs.txt", log_fp)
     ]:
         if obj is None:
-            "Skipping {}{}, no data available".format(output_prefix, suffix)
+            logging.info("Skipping {}{}, no data available".format(output_prefix, suffix))
             continue
 
-        fp = os.path.join(temp_folder, output_prefix + suffix)
-        if suffix.endswith(".feather"):
-            obj.reset_index().to_feather(fp)
-        elif suffix.endswith(".json.gz"):
-            json.dump(obj, gzip.open(fp, "wt"))
-        elif suffix.endswith(".txt"):
-            with open(fp, "wt") as f:
-                f.write(obj)
-        else:
-            raise Exception(
-                "Object cannot be written, no method for " + suffix)
-
-        if output_folder.startswith("s3://"):
-            bucket, prefix = output_folder[5:].split("/", 1)
-
-            # Make the full name of the destination key
-            file_prefix = prefix + output_prefix + suffix
+        dest_fp = output_folder + output_prefix + suffix
+        logging.info("Writing " + dest_fp)
 
-            # Copy the file
-            logging.info("Copying {} to {}/{}".format(
-                fp,
-                bucket,
-                file_prefix
+        # Objects are streamed to S3 as they are written
+        try:
+            with storage.open_write(dest_fp) as f:
+                write_output(obj, suffix, f)
+            continue
+        except Exception as e:
+            if not dest_fp.startswith("s3://"):
+                raise
+            logging.info("Streaming to S3 failed ({}), staging in {}".format(
+                e, temp_folder
             ))
-            s3.Bucket(bucket).upload_file(fp, file_prefix)
 
-        else:
-            # Copy as a local file
-            logging.info("Copying {} to {}".format(
-                fp, output_folder
-            ))
-            shutil.copy(fp, output_folder)
+        # Fall back to writing a local file and uploading it
+        fp = os.path.join(temp_folder, output_prefix + suffix)
+        with open(fp, "wb") as f:
+            write_output(obj, suffix, f)
+        logging.info("Copying {} to {}".format(fp, dest_fp))
+        storage.put_file(fp, dest_fp)
 
 
 def read_eggnog_annot(eggnog_tsv_fp, eggnog_annot_field):
-    """Read in the eggNOG TSV and group queries by annotation."""
-    assert eggnog_annot_field in ["eggNOG", "KO", "GO"], eggnog_annot_field
+    """Read in the eggNOG TSV (or Parquet) and group queries by annotation."""
+    assert eggnog_annot_field in ANNOT_COLUMNS, eggnog_annot_field
 
     # Keys are the annotation, values are sets of gene IDs (queries)
     eggnog_annot = defaultdict(set)
 
-    # Parse the eggNOG output
-    for line in parse_gzipped_tsv(eggnog_tsv_fp):
-        
-        # Name for the query
-        try:
-            gene_id = line[0]
-        except:
-            logging.info("Problem")
-            logging.info(line)
-            assert 1 == 0
-
-        # Parse the eggNOG annotation field
-        if eggnog_annot_field == "KO":
-            annots = line[6].split(",")
-        elif eggnog_annot_field == "GO":
-            annots = line[5].split(",")
-        else:
-            assert eggnog_annot_field == "eggNOG"
-            annots = [line[1]]
+    # Only the query name and the annotation field are read
+    for gene_id, annots in eggnog_table.iter_rows(
+        eggnog_tsv_fp,
+        ["query_name", ANNOT_COLUMNS[eggnog_annot_field]]
+    ):
+
+        # The KO and GO fields are lists, while each query has a single eggNOG ortholog
+        if annots is None:
+            continue
+        elif not isinstance(annots, list):
+            annots = [annots]
 
         # Add this gene to the set of annotations
         for a in annots:
@@ -252,31 +447,52 @@ def read_eggnog_annot(eggnog_tsv_fp, eggnog_annot_field):
 
 def calculate_proportions_by_eggnog_annot(df, eggnog_annot):
     """Calculate the proportion of each sample contained within each of the annotations."""
+    import numpy as np
+    import pandas as pd
+    import scipy.sparse
+
+    # Make a flat list of every (annotation, gene) pair
+    annot_list = []
+    gene_list = []
+    for annot_id, annot_gene_set in eggnog_annot.items():
+        annot_list.extend([annot_id] * len(annot_gene_set))
+        gene_list.extend(annot_gene_set)
+
+    # Genes listed more than once are summed, which is how each of their rows was counted before
+    if not df.index.is_unique:
+        logging.warning("Summing the abundances of {:,} duplicated gene IDs".format(
+            df.index.duplicated().sum()
+        ))
+        df = df.groupby(level=0).sum()
 
-    # Get the intersection of genes with annotations that also are in the abundance DataFrame
-    df_gene_id_set = set(df.index.values)
-    eggnog_annot = {
-        eggnog_id: gene_list & df_gene_id_set
-        for eggnog_id, gene_list in eggnog_annot.items()
-    }
-    # Remove the annotations with 0 genes in this set of samples
-    eggnog_annot_id_list = []
-    eggnog_annot_gene_list_of_lists = []
-    for annot_id, gene_list in eggnog_annot:
-        if len(gene_list) > 0:
-            eggnog_annot_id_list.append(annot_id)
-            eggnog_annot_gene_list_of_lists.append(gene_list)
+    # Get the position of each gene in the abundance DataFrame (-1 if absent)
+    gene_ix = df.index.get_indexer(gene_list)
+    in_df = gene_ix >= 0
+
+    # Assign integer codes to the annotations with at least 1 gene in this set of samples
+    annot_codes, eggnog_annot_id_list = pd.factorize(
+        np.array(annot_list, dtype=object)[in_df]
+    )
 
     logging.info("Grouping {:,} genes (out of a total set of {:,} genes) into {:,} eggNOG annotations".format(
-        sum(map(len, eggnog_annot_gene_list_of_lists)),
+        len(set(gene_ix[in_df])),
         df.shape[0],
-        len(eggnog_annot_gene_list_of_lists)
+        len(eggnog_annot_id_list)
     ))
 
-    eggnog_df = pd.DataFrame([
-        df.loc[gene_list].sum()
-        for gene_list in eggnog_annot_gene_list_of_lists
-    ], index=eggnog_annot_id_list)
+    # Sparse indicator matrix of annotations by genes
+    indicator = scipy.sparse.csr_matrix(
+        (np.ones(in_df.sum()), (annot_codes, gene_ix[in_df])),
+        shape=(len(eggnog_annot_id_list), df.shape[0])
+    )
+
+    # Sum up the genes in every annotation at once
+    df = df.fillna(0)
+    eggnog_df = pd.DataFrame(
+        indicator.dot(df.values),
+        index=eggnog_annot_id_list,
+        columns=df.columns
+    )
 
     # Calculate the proportion of each sample going into each group
     logging.info("Calculating proportional abundance per sample")
@@ -295,6 +511,12 @@ def make_eggnog_abundance_dataframe(
     results_key="results",
     abundance_key="depth",
     gene_id_key="id",
+    existing_table=None,
+    existing_manifest=None,
+    cache_folder=None,
+    abundance_matrix=None,
+    threads=1,
+    output_format="feather",
 ):
     # Make a new temp folder
     temp_folder = os.path.join(temp_folder, str(uuid.uuid4())[:8])
@@ -332,38 +554,117 @@ def make_eggnog_abundance_dataframe(
     except:
         exit_and_clean_up(temp_folder)
 
-    # Read in the sample_sheet
-    logging.info("Reading in the sample sheet from " + sample_sheet)
-    try:
-        sample_sheet = read_json(sample_sheet)
-    except:
-        exit_and_clean_up(temp_folder)
+    if abundance_matrix is not None:
+        # Aggregate a table of gene abundances which has already been assembled
+        logging.info("Making the abundance DataFrame from " + abundance_matrix)
+        try:
+            df = calculate_proportions_by_eggnog_annot(
+                storage.read_abundance_table(abundance_matrix),
+                eggnog_annot
+            )
+        except:
+            exit_and_clean_up(temp_folder)
 
-    # Make the abundance DataFrame
-    logging.info("Making the abundance DataFrame")
-    try:
-        df = read_eggnog_proportion_df(
-            eggnog_annot,
-            sample_sheet,
-            results_key,
-            abundance_key,
-            gene_id_key
-        )
-    except:
-        exit_and_clean_up(temp_folder)
+        # Individual samples are not tracked for incremental updates
+        manifest = None
 
-    # Read in the logs
-    logs = "\n".join(open(log_fp, "rt").readlines())
+    else:
+        # Read in the sample_sheet
+        logging.info("Reading in the sample sheet from " + sample_sheet)
+        try:
+            sample_sheet = read_json(sample_sheet)
+        except:
+            exit_and_clean_up(temp_folder)
+
+        # Record the version of each input, so that later runs can skip unchanged samples
+        logging.info("Fingerprinting the eggNOG annotations and samples")
+        try:
+            annot_fingerprint = hash_eggnog_annot(eggnog_annot)
+            annot_digests = digest_eggnog_annot(eggnog_annot)
+            sample_etags = dict(zip(
+                sample_sheet.keys(),
+                map_threads(storage.get_etag, list(sample_sheet.values()), threads)
+            ))
+        except:
+            exit_and_clean_up(temp_folder)
+
+        manifest = {
+            "eggnog_tsv_fp": eggnog_tsv_fp,
+            "eggnog_annot_field": eggnog_annot_field,
+            "annotation_index": annot_fingerprint,
+            "annotation_digests": annot_digests,
+            "samples": {
+                str(sample_name): {
+                    "path": sample_path,
+                    "etag": sample_etags[sample_name]
+                }
+                for sample_name, sample_path in sample_sheet.items()
+            }
+        }
+
+        # Cached proportions are only reused if every input is the same
+        cache_keys = {
+            sample_name: make_cache_key(
+                sample_etags[sample_name],
+                annot_fingerprint,
+                eggnog_annot_field,
+                results_key,
+                abundance_key,
+                gene_id_key
+            )
+            for sample_name in sample_sheet
+        }
+        if cache_folder is not None:
+            logging.info("Using the sample cache in " + cache_folder)
+
+        # Make the abundance DataFrame
+        if existing_table is not None:
+            logging.info("Updating the abundance DataFrame from " + existing_table)
+            try:
+                df = update_eggnog_proportion_df(
+                    storage.read_abundance_table(existing_table),
+                    read_json(existing_manifest),
+                    eggnog_annot,
+                    annot_fingerprint,
+                    annot_digests,
+                    sample_sheet,
+                    sample_etags,
+                    results_key,
+                    abundance_key,
+                    gene_id_key,
+                    cache_folder=cache_folder,
+                    cache_keys=cache_keys,
+                    threads=threads
+                )
+            except:
+                exit_and_clean_up(temp_folder)
+        else:
+            logging.info("Making the abundance DataFrame")
+            try:
+                df = read_eggnog_proportion_df(
+                    eggnog_annot,
+                    sample_sheet,
+                    results_key,
+                    abundance_key,
+                    gene_id_key,
+                    cache_folder=cache_folder,
+                    cache_keys=cache_keys,
+                    threads=threads
+                )
+            except:
+                exit_and_clean_up(temp_folder)
 
     # Return the results
     logging.info("Returning results to " + output_folder)
     try:
         return_results(
             df,
-            logs,
+            log_fp,
             output_prefix,
             output_folder,
-            temp_folder
+            temp_folder,
+            manifest=manifest,
+            output_format=output_format
         )
     except:
         exit_and_clean_up(temp_folder)
@@ -385,11 +686,16 @@ if __name__ == "__main__":
     parser.add_argument("--eggnog-tsv-fp",
                         type=str,
                         required=True,
-                        help="""Compressed TSV with eggNOG output.""")
-    parser.add_argument("--sample-sheet",
-                        type=str,
-                        required=True,
-                        help="""Location for sample sheet (.json[.gz]).""")
+                        help="""eggNOG output, as compressed TSV (.tsv.gz or .tsv.zst) or Parquet.
+                                (Supported: s3://, or local path).""")
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument("--sample-sheet",
+                             type=str,
+                             help="""Location for sample sheet (.json[.gz]).""")
+    input_group.add_argument("--abundance-matrix",
+                             type=str,
+                             help="""Table of gene abundances (.feather or .parquet), with
+                                     gene IDs in the first column and one column per sample.""")
     parser.add_argument("--output-prefix",
                         type=str,
                         required=True,
@@ -399,6 +705,15 @@ if __name__ == "__main__":
                         required=True,
                         help="""Folder to place results.
                                 (Supported: s3://, or local path).""")
+    parser.add_argument("--threads",
+                        type=int,
+                        default=1,
+                        help="Number of samples to read concurrently (threads overlapping S3 reads, not processes).")
+    parser.add_argument("--output-format",
+                        type=str,
+                        default="feather",
+                        choices=["feather", "parquet"],
+                        help="Format for the abundance table.")
     parser.add_argument("--temp-folder",
                         type=str,
                         default="/scratch",
@@ -415,18 +730,46 @@ if __name__ == "__main__":
                         type=str,
                         default="id",
                         help="Key identifying the gene ID for each element in the results list.")
+    parser.add_argument("--existing-table",
+                        type=str,
+                        default=None,
+                        help="""Abundance table (.feather or .parquet) from a previous run to add new samples to.""")
+    parser.add_argument("--existing-manifest",
+                        type=str,
+                        default=None,
+                        help="""Manifest (.manifest.json) written alongside --existing-table.""")
+    parser.add_argument("--cache-folder",
+                        type=str,
+                        default=None,
+                        help="""Folder for caching the proportions computed for each sample.
+                                (Supported: s3://, or local path).""")
 
     args = parser.parse_args(sys.argv[1:])
 
     # Sample sheet is in JSON format
-    assert args.sample_sheet.endswith((".json", ".json.gz"))
+    if args.sample_sheet is not None:
+        assert args.sample_sheet.endswith((".json", ".json.gz"))
+
+    # Abundance matrix is in feather or Parquet format
+    if args.abundance_matrix is not None:
+        assert args.abundance_matrix.endswith((".feather", ".parquet"))
+        assert args.existing_table is None, "--existing-table requires --sample-sheet"
+        assert args.cache_folder is None, "--cache-folder requires --sample-sheet"
 
     # Normalization factor is absent, 'median', or 'sum'
     assert args.eggnog_annot_field in ["eggNOG", "KO", "GO"]
 
+    # An existing table can only be updated using its manifest
+    assert (args.existing_table is None) == (args.existing_manifest is None), \
+        "--existing-table and --existing-manifest must be used together"
+
     # Make sure the temporary folder exists
     assert os.path.exists(args.temp_folder), args.temp_folder
 
+    # Make sure the local cache folder exists
+    if args.cache_folder is not None and not args.cache_folder.startswith("s3://"):
+        assert os.path.exists(args.cache_folder), args.cache_folder
+
     make_eggnog_abundance_dataframe(
         **args.__dict__
     )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""Roll up a KO x sample abundance table to KEGG reactions, pathways and modules."""
+
+import os
+import time
+import sqlite3
+import logging
+import argparse
+import tempfile
+
+import storage
+
+
+# Links from reactions up to each level above them, from get_kegg_reaction_metadata.py
+LEVEL_LINKS = {
+    "pathway": "SELECT reaction_id, pathway_id FROM pathway_reaction;",
+    "module": "SELECT reaction_id, module_id FROM module_reaction;",
+}
+
+
+def link_matrix(pairs, from_ids, to_ids=None):
+    """Sparse indicator matrix (to x from) of a list of (from, to) links.
+
+    Links from IDs which are not in from_ids are dropped. The rows are labeled by
+    to_ids if provided, or else by every ID linked to, sorted.
+    """
+    import numpy as np
+    import pandas as pd
+    import scipy.sparse
+
+    from_ix = pd.Index(from_ids)
+    pairs = [
+        (from_id, to_id)
+        for from_id, to_id in pairs
+        if from_id in from_ix
+    ]
+    if to_ids is None:
+        to_ids = sorted(set([to_id for _, to_id in pairs]))
+    to_ix = pd.Index(to_ids)
+
+    matrix = scipy.sparse.csr_matrix(
+        (
+            np.ones(len(pairs)),
+            (
+                to_ix.get_indexer([to_id for _, to_id in pairs]),
+                from_ix.get_indexer([from_id for from_id, _ in pairs]),
+            )
+        ),
+        shape=(len(to_ix), len(from_ix))
+    )
+    # Each link is only counted once
+    matrix.data[:] = 1
+    return matrix, list(to_ids)
+
+
+def rollup_kegg_abundance(ko_df, kegg_db):
+    """Project the abundance of KOs up to reactions, pathways and modules, returning a DataFrame for each.
+
+    A reaction is given the summed abundance of every KO which catalyzes it. Pathways and
+    modules are given the summed abundance of the distinct KOs which catalyze any of their
+    reactions, so that a KO with several reactions in a pathway is only counted once.
+    """
+    import pandas as pd
+    import scipy.sparse
+
+    conn = sqlite3.connect(kegg_db)
+    ko_df = ko_df.fillna(0)
+    ko_values = scipy.sparse.csr_matrix(ko_df.values)
+
+    # Reactions x KOs
+    ko_reaction, reaction_ids = link_matrix(
+        conn.execute("SELECT ortholog_id, reaction_id FROM ortholog_has_reaction;").fetchall(),
+        ko_df.index.values
+    )
+    logging.info("Linked {:,} of {:,} KOs to {:,} reactions".format(
+        int((ko_reaction.sum(axis=0) > 0).sum()),
+        ko_df.shape[0],
+        len(reaction_ids)
+    ))
+    results = {
+        "reaction": pd.DataFrame(
+            ko_reaction.dot(ko_values).toarray(),
+            index=reaction_ids,
+            columns=ko_df.columns
+        )
+    }
+
+    for level, sql in LEVEL_LINKS.items():
+        # Level x reactions, and then level x KOs (counting each KO once)
+        reaction_level, level_ids = link_matrix(conn.execute(sql).fetchall(), reaction_ids)
+        ko_level = reaction_level.dot(ko_reaction)
+        ko_level.data[:] = 1
+
+        logging.info("Rolled up {:,} reactions to {:,} {}s".format(
+            len(reaction_ids),
+            len(level_ids),
+            level
+        ))
+        results[level] = pd.DataFrame(
+            ko_level.dot(ko_values).toarray(),
+            index=level_ids,
+            columns=ko_df.columns
+        )
+
+    conn.close()
+    return results
+
+
+def rollup_kegg_abundance_tables(
+    abundance_table=None,
+    kegg_db=None,
+    output_prefix=None,
+    output_folder=None,
+    output_format="feather",
+    cache_folder=None
+):
+    start = time.monotonic()
+    ko_df = storage.read_abundance_table(abundance_table)
+    logging.info("Read in {:,} KOs across {:,} samples".format(ko_df.shape[0], ko_df.shape[1]))
+
+    # SQLite needs a local file, which is kept for the next run
+    if cache_folder is None:
+        cache_folder = tempfile.gettempdir()
+    kegg_db = storage.cache_file(kegg_db, cache_folder)
+
+    for level, df in rollup_kegg_abundance(ko_df, kegg_db).items():
+        fp = "{}/{}.{}.{}".format(output_folder.rstrip("/"), output_prefix, level, output_format)
+        logging.info("Writing " + fp)
+        df.index.name = level + "_id"
+        with storage.open_write(fp) as f:
+            if output_format == "parquet":
+                df.reset_index().to_parquet(f)
+            else:
+                df.reset_index().to_feather(f)
+
+    logging.info("Done in {:.1f}s".format(time.monotonic() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Roll up a KO x sample abundance table to KEGG reactions, pathways and modules"""
+    )
+
+    parser.add_argument("--abundance-table",
+                        type=str,
+                        required=True,
+                        help="""KO abundances (.feather or .parquet) from make_eggnog_abundance_dataframe.py,
+                                with KO IDs in the first column and one column per sample.
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--kegg-db",
+                        type=str,
+                        required=True,
+                        help="""SQLite database from get_kegg_reaction_metadata.py.
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--output-prefix",
+                        type=str,
+                        required=True,
+                        help="""Prefix for output files, written as <prefix>.<level>.<format>.""")
+    parser.add_argument("--output-folder",
+                        type=str,
+                        required=True,
+                        help="""Folder to place results.
+                                (Supported: s3://, or local path).""")
+    parser.add_argument("--output-format",
+                        type=str,
+                        default="feather",
+                        choices=["feather", "parquet"],
+                        help="Format for the abundance tables.")
+    parser.add_argument("--cache-folder",
+                        type=str,
+                        default=None,
+                        help="""Folder for keeping a local copy of an s3:// --kegg-db between runs
+                                (default: the system temporary folder).""")
+
+    args = parser.parse_args()
+
+    # Set up logging
+    logFormatter = logging.Formatter(
+        '%(asctime)s %(levelname)-8s [rollup_kegg_abundance] %(message)s'
+    )
+    rootLogger = logging.getLogger()
+    rootLogger.setLevel(logging.INFO)
+
+    # Also write to STDOUT
+    consoleHandler = logging.StreamHandler()
+    consoleHandler.setFormatter(logFormatter)
+    rootLogger.addHandler(consoleHandler)
+
+    assert storage.exists(args.kegg_db), args.kegg_db
+    if not storage.is_remote(args.output_folder):
+        assert os.path.exists(args.output_folder), args.output_folder
+    if args.cache_folder is not None:
+        assert os.path.exists(args.cache_folder), args.cache_folder
+
+    rollup_kegg_abundance_tables(**args.__dict__)
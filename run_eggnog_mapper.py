@@ -10,6 +10,8 @@ import argparse
 import traceback
 import subprocess
 
+import storage
+
 
 def exit_and_clean_up(temp_folder):
     """Log the error messages and delete the temporary folder."""
@@ -77,42 +79,27 @@ def get_file_from_url(file_url, temp_folder):
     logging.info("Filename: " + filename)
     logging.info("Local path: " + local_path)
 
-    # Get files from AWS S3
-    if file_url.startswith('s3://'):
-        logging.info("Getting reads from S3")
-        run_cmds([
-            'aws', 's3', 'cp', '--quiet', '--sse',
-            'AES256', file_url, temp_folder
-        ])
-
-    # Get files from an FTP server
-    elif file_url.startswith('ftp://'):
-        logging.info("Getting reads from FTP")
-        run_cmds(['wget', '-P', temp_folder, file_url])
+    # Get files from AWS S3 or an FTP server
+    if storage.is_remote(file_url):
+        logging.info("Getting reads from " + file_url.split(":", 1)[0].upper())
+        storage.download_file(file_url, local_path)
 
-    elif file_url.startswith(('s3://', 'ftp://')):
+    else:
         logging.info("Treating as local path")
         msg = "Input file does not exist ({})".format(file_url)
         assert os.path.exists(file_url), msg
         logging.info("Making symbolic link in temporary folder")
         os.symlink(file_url, local_path)
-        return local_path
 
     return local_path
 
 
 def safe_copy_file(path_from, path_to):
     """Copy a file, either locally or to S3."""
-    if path_to.startswith("s3://"):
-        try:
-            run_cmds(["aws", "s3", "cp", "--quiet", path_from, path_to])
-        except:
-            exit_and_clean_up(temp_folder)
-    else:
-        try:
-            os.rename(path_from, path_to)
-        except:
-            exit_and_clean_up(temp_folder)
+    try:
+        storage.put_file(path_from, path_to)
+    except:
+        exit_and_clean_up(temp_folder)
 
 
 if __name__ == "__main__":
@@ -133,6 +120,10 @@ if __name__ == "__main__":
                         type=str,
                         required=True,
                         help="""Output in TSV.GZ format.""")
+    parser.add_argument("--output-tsv-zst",
+                        type=str,
+                        default=None,
+                        help="""Optional copy of the output in TSV.ZST format.""")
     parser.add_argument("--output-logs",
                         type=str,
                         required=True,
@@ -180,6 +171,8 @@ if __name__ == "__main__":
 
     # Make sure that the output-args-tsv ends with .tsv.gz
     assert args.output_tsv_gz.endswith(".tsv.gz"), "Output path must end .tsv.gz"
+    if args.output_tsv_zst is not None:
+        assert args.output_tsv_zst.endswith(".tsv.zst"), "Output path must end .tsv.zst"
 
     # Get the reference database
     local_db_folder = os.path.join(temp_folder, "db") + "/"
@@ -188,9 +181,7 @@ if __name__ == "__main__":
             args.db, local_db_folder
         ))
         try:
-            run_cmds([
-                "aws", "s3", "sync", "--quiet", args.db, local_db_folder
-            ])
+            storage.sync_folder(args.db, local_db_folder, threads=args.cpu)
         except:
             exit_and_clean_up(temp_folder)
     else:
@@ -231,15 +222,17 @@ if __name__ == "__main__":
     except:
         exit_and_clean_up(temp_folder)
 
-    # Compress the output file
-    try:
-        run_cmds(["gzip", local_output_file])
-        local_output_file = local_output_file + ".gz"
-    except:
-        exit_and_clean_up(temp_folder)
-
-    logging.info("Copying output to " + args.output_tsv_gz)
-    safe_copy_file(local_output_file, args.output_tsv_gz)
+    # Compress the output while it is copied, streaming it to S3 in parallel parts
+    for output_fp in [args.output_tsv_gz, args.output_tsv_zst]:
+        if output_fp is None:
+            continue
+        logging.info("Copying output to " + output_fp)
+        try:
+            with open(local_output_file, "rb") as f_in:
+                with storage.open_write(output_fp) as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1 << 20)
+        except:
+            exit_and_clean_up(temp_folder)
 
     logging.info("Copying logs to {}".format(args.output_logs))
     safe_copy_file(log_fp, args.output_logs)
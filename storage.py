@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+"""Read and write files on S3, FTP or the local filesystem, with transparent compression.
+
+Paths ending in .gz or .zst are compressed and decompressed as they are streamed.
+"""
+
+import os
+import io
+import sys
+import glob
+import gzip
+import uuid
+import shutil
+import fnmatch
+import hashlib
+import logging
+import threading
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+# Settings for the S3 connections which are shared by all reads and writes
+S3_MAX_POOL_CONNECTIONS = 32
+S3_MAX_ATTEMPTS = 10
+# Objects larger than this are transferred in parallel parts
+S3_RANGE_SIZE = 16 * 1024 * 1024
+S3_RANGE_THREADS = 8
+
+# Each thread keeps its own S3 client, which is reused for every request
+s3_local = threading.local()
+
+# Threads downloading the parts of large objects, which are shared by every read
+# (so that their S3 clients are reused), and made on first use
+range_pool = None
+range_pool_pid = None
+range_pool_lock = threading.Lock()
+
+# Paths which are fetched over the network, rather than read from disk
+REMOTE_PREFIXES = ("s3://", "ftp://", "http://", "https://")
+
+
+def is_remote(fp):
+    return fp.startswith(REMOTE_PREFIXES)
+
+
+def get_s3_client():
+    """Return the S3 client for the current thread, creating it on first use."""
+    # boto3 is only imported for S3 paths, which keeps local runs quick to start
+    import boto3
+    import botocore.config
+
+    # Clients are not shared with processes forked after they were made
+    if getattr(s3_local, "client", None) is None or s3_local.pid != os.getpid():
+        # Sessions are not thread-safe, so each thread makes its own
+        s3_local.client = boto3.session.Session().client(
+            's3',
+            config=botocore.config.Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                retries={
+                    "max_attempts": S3_MAX_ATTEMPTS,
+                    "mode": "adaptive"
+                }
+            )
+        )
+        s3_local.pid = os.getpid()
+    return s3_local.client
+
+
+def get_range_pool():
+    """Return the pool of threads used for ranged GETs, creating it on first use."""
+    global range_pool, range_pool_pid
+
+    with range_pool_lock:
+        # Pools are not shared with processes forked after they were made
+        if range_pool is None or range_pool_pid != os.getpid():
+            range_pool = ThreadPool(S3_RANGE_THREADS)
+            range_pool_pid = os.getpid()
+        return range_pool
+
+
+def get_transfer_config():
+    """Settings for parallel multipart uploads and downloads of whole files."""
+    import boto3.s3.transfer
+
+    return boto3.s3.transfer.TransferConfig(
+        multipart_threshold=S3_RANGE_SIZE,
+        multipart_chunksize=S3_RANGE_SIZE,
+        max_concurrency=S3_RANGE_THREADS
+    )
+
+
+def parse_s3_path(fp):
+    """Split an s3:// path into the bucket and key."""
+    assert fp.startswith("s3://"), fp
+    bucket_name, key_name = fp[5:].split("/", 1)
+    return bucket_name, key_name
+
+
+def read_s3_range(bucket_name, key_name, etag, start, end):
+    """Download a single byte range of an S3 object."""
+    retr = get_s3_client().get_object(
+        Bucket=bucket_name,
+        Key=key_name,
+        Range="bytes={}-{}".format(start, end - 1),
+        IfMatch=etag
+    )
+    return retr['Body'].read()
+
+
+def read_s3_object(fp):
+    """Download an S3 object into memory, splitting large objects into parallel ranged GETs."""
+    bucket_name, key_name = parse_s3_path(fp)
+    s3 = get_s3_client()
+
+    head = s3.head_object(Bucket=bucket_name, Key=key_name)
+    size = head["ContentLength"]
+
+    if size <= S3_RANGE_SIZE:
+        retr = s3.get_object(
+            Bucket=bucket_name,
+            Key=key_name,
+            IfMatch=head["ETag"]
+        )
+        return retr['Body'].read()
+
+    # Reads from several threads share the same S3_RANGE_THREADS connections
+    logging.info("Downloading {:,} bytes from {} in parallel".format(size, fp))
+    parts = get_range_pool().map(
+        lambda start: read_s3_range(
+            bucket_name,
+            key_name,
+            head["ETag"],
+            start,
+            min(start + S3_RANGE_SIZE, size)
+        ),
+        range(0, size, S3_RANGE_SIZE)
+    )
+    return b"".join(parts)
+
+
+def upload_s3_file(local_fp, fp):
+    """Upload a local file to S3, using parallel multipart transfers for large files."""
+    bucket_name, key_name = parse_s3_path(fp)
+    get_s3_client().upload_file(
+        local_fp,
+        bucket_name,
+        key_name,
+        Config=get_transfer_config()
+    )
+
+
+def download_s3_file(fp, local_fp):
+    """Download an S3 object to a local file, using parallel ranged GETs for large objects."""
+    bucket_name, key_name = parse_s3_path(fp)
+    get_s3_client().download_file(
+        bucket_name,
+        key_name,
+        local_fp,
+        Config=get_transfer_config()
+    )
+
+
+class S3MultipartWriter(object):
+    """File-like object which uploads to S3 in parts while data is being written."""
+
+    def __init__(self, fp, part_size=S3_RANGE_SIZE, threads=S3_RANGE_THREADS):
+        self.bucket_name, self.key_name = parse_s3_path(fp)
+        self.part_size = part_size
+        self.threads = threads
+        self.buffer = bytearray()
+        self.position = 0
+        self.closed = False
+        self.upload_id = None
+        self.pool = None
+        self.pending_parts = []
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        assert not self.closed, "Writing to a closed file"
+        self.buffer.extend(data)
+        self.position += len(data)
+
+        # Send every complete part
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+        return len(data)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            retr = get_s3_client().create_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key_name
+            )
+            self.upload_id = retr["UploadId"]
+            self.pool = ThreadPool(self.threads)
+
+        # Limit the number of parts held in memory while uploading
+        while len(self.pending_parts) >= self.threads:
+            self.parts.append(self.pending_parts.pop(0).get())
+
+        self.pending_parts.append(self.pool.apply_async(
+            upload_s3_part,
+            (self.bucket_name, self.key_name, self.upload_id,
+             len(self.parts) + len(self.pending_parts) + 1, data)
+        ))
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self._complete()
+        except Exception:
+            # Parts of an upload which is never completed are still billed
+            self.abort()
+            raise
+
+        self.buffer = bytearray()
+        self.closed = True
+
+    def _complete(self):
+        if self.upload_id is None:
+            # Small objects are sent in a single request
+            get_s3_client().put_object(
+                Bucket=self.bucket_name,
+                Key=self.key_name,
+                Body=bytes(self.buffer)
+            )
+        else:
+            # The last part is allowed to be smaller than the rest
+            if len(self.buffer) > 0:
+                self._upload_part(bytes(self.buffer))
+            self.parts.extend([part.get() for part in self.pending_parts])
+            self.pending_parts = []
+            self.pool.close()
+
+            get_s3_client().complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key_name,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts}
+            )
+
+    def abort(self):
+        """Discard everything which has been uploaded."""
+        if self.closed:
+            return
+
+        if self.upload_id is not None:
+            self.pool.terminate()
+            get_s3_client().abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key_name,
+                UploadId=self.upload_id
+            )
+
+        self.buffer = bytearray()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def upload_s3_part(bucket_name, key_name, upload_id, part_number, data):
+    """Upload a single part of a multipart upload."""
+    retr = get_s3_client().upload_part(
+        Bucket=bucket_name,
+        Key=key_name,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=data
+    )
+    return {"ETag": retr["ETag"], "PartNumber": part_number}
+
+
+class ReadStream(io.RawIOBase):
+    """Raw stream over anything with a read(n) method, such as the body of an S3 response."""
+
+    def __init__(self, source):
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.source.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super(ReadStream, self).close()
+
+
+def import_zstandard(fp):
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("The zstandard package is needed for " + fp)
+    return zstandard
+
+
+def exists(fp):
+    """Check whether a file exists, without downloading it."""
+    if fp.startswith("s3://"):
+        import botocore.exceptions
+
+        bucket_name, key_name = parse_s3_path(fp)
+        try:
+            get_s3_client().head_object(Bucket=bucket_name, Key=key_name)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    elif is_remote(fp):
+        # Other servers are only checked when the file is read
+        return True
+
+    else:
+        return os.path.exists(fp)
+
+
+def get_etag(fp):
+    """Return an identifier which changes whenever the contents of a file change."""
+    if fp.startswith("s3://"):
+        # Parse the S3 bucket and key
+        bucket_name, key_name = parse_s3_path(fp)
+
+        # Get the ETag without downloading the object
+        retr = get_s3_client().head_object(Bucket=bucket_name, Key=key_name)
+        return retr["ETag"].strip('"')
+
+    else:
+        assert os.path.exists(fp), fp
+
+        # Hash the contents of the local file
+        md5 = hashlib.md5()
+        with open(fp, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                md5.update(block)
+        return md5.hexdigest()
+
+
+def list_files(pattern):
+    """Expand a glob of local paths or S3 keys, e.g. s3://bucket/annotations/*.tsv.gz."""
+    if not pattern.startswith("s3://"):
+        return sorted(glob.glob(pattern))
+
+    # Only the keys before the first wildcard are listed
+    bucket_name, key_pattern = parse_s3_path(pattern)
+    prefix = key_pattern
+    for wildcard in "*?[":
+        prefix = prefix.split(wildcard, 1)[0]
+    if prefix == key_pattern:
+        return [pattern] if exists(pattern) else []
+
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    return sorted([
+        "s3://{}/{}".format(bucket_name, obj["Key"])
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        for obj in page.get("Contents", [])
+        if fnmatch.fnmatchcase(obj["Key"], key_pattern)
+    ])
+
+
+def read_bytes(fp):
+    """Read the entire (still compressed) contents of a file."""
+    if fp.startswith("s3://"):
+        return read_s3_object(fp)
+    elif is_remote(fp):
+        f = urlopen(fp)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    else:
+        with open(fp, "rb") as f:
+            return f.read()
+
+
+def read_abundance_table(fp):
+    """Read in a table of abundances in feather or Parquet format, indexed by the first column."""
+    import pandas as pd
+
+    assert fp.endswith((".feather", ".parquet")), fp
+    assert exists(fp), fp
+    logging.info("Reading in " + fp)
+
+    # Both formats need random access, so remote tables are read into memory
+    if is_remote(fp):
+        f = io.BytesIO(read_bytes(fp))
+    else:
+        f = fp
+
+    if fp.endswith(".parquet"):
+        df = pd.read_parquet(f)
+    else:
+        df = pd.read_feather(f)
+
+    # The row labels are in the first column
+    return df.set_index(df.columns.values[0])
+
+
+def open_raw(fp):
+    """Open a file for streaming reads of its (still compressed) contents."""
+    if fp.startswith("s3://"):
+        bucket_name, key_name = parse_s3_path(fp)
+        retr = get_s3_client().get_object(Bucket=bucket_name, Key=key_name)
+        return io.BufferedReader(ReadStream(retr["Body"]), S3_RANGE_SIZE // 16)
+    elif is_remote(fp):
+        return io.BufferedReader(ReadStream(urlopen(fp)))
+    else:
+        # io.open gives the same file object in Python 2 and 3, which TextIOWrapper can read
+        return io.open(fp, "rb")
+
+
+@contextlib.contextmanager
+def open_read(fp, mode="rb", cache_folder=None):
+    """Stream a file from any location, decompressing .gz and .zst files as they are read.
+
+    Remote files are first copied into cache_folder, if provided, and read from there.
+    """
+    assert mode in ("rb", "rt"), mode
+    if cache_folder is not None:
+        fp_local = cache_file(fp, cache_folder)
+    else:
+        fp_local = fp
+
+    # Every layer is closed once the file has been read
+    layers = [open_raw(fp_local)]
+    try:
+        if fp.endswith(".gz"):
+            layers.append(gzip.GzipFile(None, "rb", fileobj=layers[-1]))
+            # GzipFile has no read1() in Python 2, which TextIOWrapper needs
+            if sys.version_info[0] == 2:
+                layers[-1] = io.BufferedReader(layers[-1])
+        elif fp.endswith(".zst"):
+            zstandard = import_zstandard(fp)
+            layers.append(io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(layers[-1], read_across_frames=True)
+            ))
+        if mode == "rt":
+            layers.append(io.TextIOWrapper(layers[-1], encoding="utf-8"))
+
+        yield layers[-1]
+
+    finally:
+        for f in layers[::-1]:
+            f.close()
+
+
+@contextlib.contextmanager
+def open_write(fp):
+    """Write a file to S3 or the local filesystem, compressing .gz and .zst files as they are written.
+
+    S3 objects are uploaded in parallel parts while they are written, and local files are
+    written under a temporary name, so that partial files are never left behind on errors.
+    """
+    if fp.startswith("s3://"):
+        f = S3MultipartWriter(fp)
+        temp_fp = None
+    else:
+        assert not is_remote(fp), "Cannot write to " + fp
+        temp_fp = "{}.{}".format(fp, str(uuid.uuid4())[:8])
+        f = open(temp_fp, "wb")
+
+    try:
+        if fp.endswith(".gz"):
+            compressed = gzip.GzipFile(None, "wb", fileobj=f)
+        elif fp.endswith(".zst"):
+            zstandard = import_zstandard(fp)
+            compressed = zstandard.ZstdCompressor().stream_writer(f)
+        else:
+            compressed = None
+
+        if compressed is None:
+            yield f
+        else:
+            yield compressed
+            compressed.close()
+
+        # Completing the upload or renaming the file can fail too, which is cleaned up below
+        f.close()
+        if temp_fp is not None:
+            os.rename(temp_fp, fp)
+
+    except Exception:
+        if temp_fp is None:
+            f.abort()
+        else:
+            f.close()
+            if os.path.exists(temp_fp):
+                os.remove(temp_fp)
+        raise
+
+
+def download_file(fp, local_fp):
+    """Copy a file from any location to a local path, without decompressing it."""
+    logging.info("Downloading {} to {}".format(fp, local_fp))
+    if fp.startswith("s3://"):
+        download_s3_file(fp, local_fp)
+    elif is_remote(fp):
+        f = urlopen(fp)
+        try:
+            with open(local_fp, "wb") as f_out:
+                shutil.copyfileobj(f, f_out, 1 << 20)
+        finally:
+            f.close()
+    else:
+        shutil.copyfile(fp, local_fp)
+
+
+def put_file(local_fp, fp):
+    """Place a local file at any location, uploading it to S3 in parallel parts or moving it locally."""
+    if fp.startswith("s3://"):
+        upload_s3_file(local_fp, fp)
+    else:
+        assert not is_remote(fp), "Cannot write to " + fp
+        shutil.move(local_fp, fp)
+
+
+def cache_file(fp, cache_folder):
+    """Return a local copy of a remote file, downloading it into cache_folder unless it is already there.
+
+    Copies of S3 objects are keyed by their ETag, so a changed object is downloaded again.
+    """
+    if not is_remote(fp):
+        return fp
+
+    if fp.startswith("s3://"):
+        version = get_etag(fp)
+    else:
+        version = ""
+    cache_key = hashlib.sha256("{}\t{}".format(fp, version).encode("utf-8")).hexdigest()[:16]
+    local_fp = os.path.join(cache_folder, "{}.{}".format(cache_key, fp.rsplit("/", 1)[-1]))
+
+    if os.path.exists(local_fp):
+        logging.info("Using the cached copy of {} in {}".format(fp, local_fp))
+        return local_fp
+
+    # Download under a temporary name first, so that partial files are never read
+    temp_fp = "{}.{}".format(local_fp, str(uuid.uuid4())[:8])
+    try:
+        download_file(fp, temp_fp)
+        os.rename(temp_fp, local_fp)
+    finally:
+        if os.path.exists(temp_fp):
+            os.remove(temp_fp)
+    return local_fp
+
+
+def sync_folder(fp, local_folder, threads=S3_RANGE_THREADS):
+    """Download every file under an S3 prefix into a local folder, skipping those already present."""
+    bucket_name, prefix = parse_s3_path(fp.rstrip("/") + "/")
+
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    to_download = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith("/"):
+                continue
+            local_fp = os.path.join(local_folder, obj["Key"][len(prefix):])
+            if os.path.exists(local_fp) and os.path.getsize(local_fp) == obj["Size"]:
+                continue
+            to_download.append(("s3://{}/{}".format(bucket_name, obj["Key"]), local_fp))
+
+    logging.info("Downloading {:,} files from {} to {}".format(len(to_download), fp, local_folder))
+    for local_dir in set([os.path.dirname(local_fp) for _, local_fp in to_download]):
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+
+    # Small files are fetched in parallel, and large files are split into parallel parts
+    pool = ThreadPool(threads)
+    try:
+        pool.map(lambda paths: download_s3_file(*paths), to_download)
+    finally:
+        pool.close()
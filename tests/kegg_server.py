@@ -0,0 +1,114 @@
+"""Local stand-in for the KEGG API, serving the entries in tests/data."""
+
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import kegg_flatfile
+
+ENTRIES_FP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "kegg_entries.txt")
+
+
+def read_entries():
+    with open(ENTRIES_FP) as f:
+        return kegg_flatfile.split_entries(f.read())
+
+
+def bulk_endpoints(entries):
+    """Text of the list and link endpoints used by --bulk-links, made from the fields of each entry."""
+    records = {
+        kegg_id: kegg_flatfile.parse_entry(kegg_flatfile.entry_type(kegg_id), kegg_id, entry)
+        for kegg_id, entry in entries.items()
+    }
+
+    def of_type(data_type):
+        return [
+            record for kegg_id, record in sorted(records.items())
+            if kegg_flatfile.entry_type(kegg_id) == data_type
+        ]
+
+    links = {
+        "link/rn/ko": [
+            ("ko:" + r.ortholog_id, "rn:" + rxn_id) for r in of_type("ko") for rxn_id in sorted(r.reactions)
+        ],
+        "link/pathway/rn": [
+            ("rn:" + r.reaction_id, "path:" + path_id) for r in of_type("rn") for path_id in r.pathways
+        ],
+        "link/module/pathway": [
+            ("path:" + r.pathway_id, "md:" + mod_id) for r in of_type("path") for mod_id in r.modules
+        ],
+        "link/rn/module": [
+            ("md:" + r.module_id, "rn:" + rxn_id) for r in of_type("md") for rxn_id in r.reactions
+        ],
+        "link/rn/pathway": [
+            ("path:" + r.pathway_id, "rn:" + rxn_id) for r in of_type("path") for rxn_id in r.reactions
+        ],
+        "link/compound/pathway": [
+            ("path:" + r.pathway_id, "cpd:" + comp_id) for r in of_type("path") for comp_id in r.compounds
+        ],
+        "link/compound/module": [
+            ("md:" + r.module_id, "cpd:" + comp_id) for r in of_type("md") for comp_id in r.compounds
+        ],
+    }
+    endpoints = {
+        path: "".join(["{}\t{}\n".format(a, b) for a, b in pairs])
+        for path, pairs in links.items()
+    }
+    endpoints["list/ko"] = "".join([
+        "ko:{}\t{}; {}\n".format(r.ortholog_id, r.name, r.definition) for r in of_type("ko")
+    ])
+    return endpoints
+
+
+def start_server(requested):
+    """Serve /get, /info and the bulk endpoints from the fixtures, counting every entry or endpoint requested."""
+    entries = read_entries()
+    endpoints = bulk_endpoints(entries)
+    endpoints["info/kegg"] = "kegg             Kyoto Encyclopedia of Genes and Genomes\nkegg             Release 113.0+/01-18, Jan 25\n"
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path = self.path.lstrip("/")
+            if path.startswith("get/"):
+                kegg_keys = path[len("get/"):].split("+")
+                requested.update(kegg_keys)
+                body = "".join([
+                    entries[kegg_key.split(":", 1)[1]]
+                    for kegg_key in kegg_keys
+                    if kegg_key.split(":", 1)[1] in entries
+                ])
+            else:
+                requested.update([path])
+                body = endpoints.get(path, "")
+            body = body.encode("utf-8")
+            # Like KEGG, a request for entries which do not exist is not found
+            self.send_response(200 if len(body) > 0 else 404)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_input_tsv(fp, kos):
+    """Annotations with one query for each comma-separated list of orthologs."""
+    import eggnog_table
+
+    with open(fp, "w") as f:
+        f.write("#" + "\t".join(eggnog_table.COLUMNS) + "\n")
+        for ix, ko in enumerate(kos):
+            row = [""] * len(eggnog_table.COLUMNS)
+            row[0] = "query{}".format(ix)
+            row[eggnog_table.COLUMNS.index("KEGG_KOs")] = ko
+            f.write("\t".join(row) + "\n")
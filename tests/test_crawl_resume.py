@@ -0,0 +1,52 @@
+"""Tests of resuming a crawl of KEGG, against a local server with the entries in tests/data."""
+
+import sqlite3
+from collections import Counter
+
+import get_kegg_reaction_metadata
+from kegg_server import start_server, write_input_tsv
+
+
+def test_resume_fetches_each_entry_once(tmp_path):
+    fetched = Counter()
+    server = start_server(fetched)
+    input_tsv = str(tmp_path / "annotations.tsv")
+    output_db = str(tmp_path / "kegg.db")
+    write_input_tsv(input_tsv, ["K00001", "K00844,K00873", ""])
+
+    def run():
+        get_kegg_reaction_metadata.get_kegg_reaction_metadata(
+            input_tsv=input_tsv,
+            output_db=output_db,
+            threads=2,
+            requests_per_second=1000,
+            kegg_url="http://127.0.0.1:{}".format(server.server_port)
+        )
+
+    try:
+        run()
+        assert fetched["ko:K00873"] == 1
+        assert fetched["path:rn00010"] == 1
+        assert fetched["md:M00001"] == 1
+
+        # Leave the database as a run which was interrupted before fetching a pathway and a module
+        conn = sqlite3.connect(output_db)
+        conn.execute("DELETE FROM pathway WHERE pathway_id = 'rn00010';")
+        conn.execute("DELETE FROM module WHERE module_id = 'M00001';")
+        conn.execute("UPDATE crawl_queue SET state = 'queued' WHERE kegg_id IN ('rn00010', 'M00001');")
+        conn.commit()
+        conn.close()
+
+        fetched.clear()
+        run()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Only the entries left in the queue are fetched, and only once
+    assert fetched == Counter({"path:rn00010": 1, "md:M00001": 1})
+
+    conn = sqlite3.connect(output_db)
+    assert conn.execute("SELECT COUNT(*) FROM pathway WHERE pathway_id = 'rn00010';").fetchone() == (1, )
+    assert conn.execute("SELECT COUNT(*) FROM crawl_queue WHERE state != 'fetched';").fetchone() == (0, )
+    conn.close()
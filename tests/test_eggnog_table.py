@@ -0,0 +1,54 @@
+"""Tests of reading the eggNOG mapper annotations as TSV and Parquet."""
+
+import gzip
+
+import pytest
+
+import eggnog_table
+import get_kegg_reaction_metadata
+
+ROWS = [
+    ["q1", "9606.ENSP1", "1.5e-10", "100.0", "adh", "GO:0001,GO:0002", "K00001,K00844", "", "Bacteria", "COG1", "", "C", "alcohol dehydrogenase"],
+    ["q2", "9606.ENSP2", "", "", "", "", "", "", "Bacteria", "", "", "", ""],
+    ["q3", "9606.ENSP1", "2e-5", "50.0", "", "", "K00873", "ACALD", "Bacteria", "COG2,COG3", "", "C", ""],
+]
+
+
+def write_tsv(fp, rows):
+    with gzip.open(fp, "wt") as f:
+        f.write("# emapper version\n")
+        f.write("#" + "\t".join(eggnog_table.COLUMNS) + "\n")
+        for row in rows:
+            f.write("\t".join(row) + "\n")
+
+
+def test_tsv_and_parquet_match(tmp_path):
+    pytest.importorskip("pyarrow")
+    tsv_fp = str(tmp_path / "annotations.tsv.gz")
+    parquet_fp = str(tmp_path / "annotations.parquet")
+    write_tsv(tsv_fp, ROWS)
+    eggnog_table.write_parquet(tsv_fp, parquet_fp)
+
+    columns = ["query_name", "seed_ortholog_evalue", "predicted_gene_name", "KEGG_KOs", "OGs"]
+    tsv_rows = list(eggnog_table.iter_rows(tsv_fp, columns))
+    assert tsv_rows == list(eggnog_table.iter_rows(parquet_fp, columns))
+    assert tsv_rows[0] == ("q1", 1.5e-10, "adh", ["K00001", "K00844"], ["COG1"])
+    # Empty lists are [], and other empty fields are None
+    assert tsv_rows[1] == ("q2", None, None, [], [])
+
+
+def test_query_orthologs_skip_missing_values(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    # Parquet written by other tools may hold nulls and blank strings
+    parquet_fp = str(tmp_path / "annotations.parquet")
+    pq.write_table(pa.table({
+        "query_name": ["q1", "q2", "q3"],
+        "KEGG_KOs": [["K00001", " K00844"], None, ["", " "]],
+    }), parquet_fp)
+
+    kegg_ids = set()
+    pairs = list(get_kegg_reaction_metadata.iter_query_orthologs(parquet_fp, kegg_ids))
+    assert pairs == [("q1", "K00001"), ("q1", "K00844")]
+    assert kegg_ids == {"K00001", "K00844"}
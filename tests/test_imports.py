@@ -0,0 +1,52 @@
+"""Check that the entry points start without importing their heavy dependencies."""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = [
+    "get_kegg_reaction_metadata.py",
+    "make_eggnog_abundance_dataframe.py",
+    "rollup_kegg_abundance.py",
+    "run_eggnog_mapper.py",
+    "kegg_flatfile.py",
+    "eggnog_table.py",
+]
+# Only imported on the code paths which use them
+HEAVY_MODULES = ["boto3", "pandas", "numpy", "scipy", "aiohttp", "pyarrow"]
+
+# Generous limit on the time taken by --help, which is well under 0.2s without the heavy imports
+MAX_HELP_SECONDS = 1.0
+
+# Run an entry point with --help in a new interpreter, and print how long
+# it took along with the heavy modules it imported
+CHECK_SCRIPT = """
+import runpy
+import sys
+import time
+sys.argv = [sys.argv[1], "--help"]
+start = time.time()
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit as e:
+    assert e.code in (0, None), e.code
+print("Seconds: {{}}".format(time.time() - start))
+print("Imported: " + ",".join([name for name in {} if name in sys.modules]))
+""".format(HEAVY_MODULES)
+
+
+@pytest.mark.parametrize("entry_point", ENTRY_POINTS)
+def test_help_does_not_import_heavy_modules(entry_point):
+    output = subprocess.check_output(
+        [sys.executable, "-c", CHECK_SCRIPT, os.path.join(ROOT, entry_point)],
+        cwd=ROOT
+    ).decode("utf-8")
+    # The help text comes before the timing and the list of modules
+    lines = output.rstrip("\n").split("\n")
+    assert lines[-1] == "Imported: ", output
+    assert lines[-2].startswith("Seconds: "), output
+    assert float(lines[-2][len("Seconds: "):]) < MAX_HELP_SECONDS, output
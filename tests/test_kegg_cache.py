@@ -0,0 +1,42 @@
+"""Tests of the cache of raw KEGG entries."""
+
+import get_kegg_reaction_metadata
+from get_kegg_reaction_metadata import KeggCache
+
+
+def test_kegg_release_number():
+    assert get_kegg_reaction_metadata.kegg_release_number("113.0+/01-18, Jan 25") == "113.0"
+    assert get_kegg_reaction_metadata.kegg_release_number(" 112.1 ") == "112.1"
+    assert get_kegg_reaction_metadata.kegg_release_number(None) is None
+
+
+def test_cache_is_kept_across_daily_updates(tmp_path):
+    cache_db = str(tmp_path / "cache.db")
+
+    cache = KeggCache(cache_db, kegg_release="113.0+/01-18, Jan 25")
+    cache.put({"ko:K00001": "ENTRY       K00001\n///\n", "cpd:C00060": None})
+    cache.close()
+
+    # The next day's update of the same release still uses the cache
+    cache = KeggCache(cache_db, kegg_release="113.0+/01-19, Jan 26")
+    assert cache.get(["ko:K00001", "cpd:C00060"]) == {"ko:K00001": "ENTRY       K00001\n///\n", "cpd:C00060": None}
+    cache.close()
+
+    # A new release does not
+    cache = KeggCache(cache_db, kegg_release="114.0+/04-01, Apr 25")
+    assert cache.get(["ko:K00001", "cpd:C00060"]) == {}
+    cache.close()
+
+
+def test_cache_with_full_release_strings(tmp_path):
+    cache_db = str(tmp_path / "cache.db")
+
+    # Entries saved by earlier versions, keyed by the full release string
+    cache = KeggCache(cache_db)
+    cache.kegg_release = "113.0+/01-18, Jan 25"
+    cache.put({"ko:K00001": "ENTRY       K00001\n///\n"})
+    cache.close()
+
+    cache = KeggCache(cache_db, kegg_release="113.0+/01-19, Jan 26")
+    assert list(cache.get(["ko:K00001"])) == ["ko:K00001"]
+    cache.close()
@@ -0,0 +1,131 @@
+"""Tests of the KEGG flat-file parser, run over the entries in tests/data."""
+
+import json
+import os
+import re
+
+import kegg_flatfile
+import get_kegg_reaction_metadata
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+ENTRIES_FP = os.path.join(DATA, "kegg_entries.txt")
+# Rows made from kegg_entries.txt by the regex parser which came before kegg_flatfile.py,
+# keyed by data type and then by table
+ROWS_FP = os.path.join(DATA, "kegg_entries.rows.json")
+
+
+def read_entries():
+    with open(ENTRIES_FP) as f:
+        return kegg_flatfile.split_entries(f.read())
+
+
+def process_rows(entries, data_type, expand=True):
+    """Rows to insert for every entry of a type, in the same form as ROWS_FP."""
+    inserts, neighbors = get_kegg_reaction_metadata.process_kegg_entries(
+        data_type,
+        [
+            (kegg_id, entries[kegg_id])
+            for kegg_id in sorted(entries)
+            if kegg_flatfile.entry_type(kegg_id) == data_type
+        ],
+        expand
+    )
+    return {
+        "rows": {
+            re.search(r"INTO (\w+)", sql).group(1): sorted([list(row) for row in rows])
+            for sql, rows in inserts.items()
+        },
+        "neighbors": {
+            neighbor_type: sorted(kegg_ids)
+            for neighbor_type, kegg_ids in neighbors.items()
+        },
+    }
+
+
+def test_split_entries():
+    entries = read_entries()
+    assert len(entries) == 15
+    assert sorted(set(map(kegg_flatfile.entry_type, entries))) == ["cpd", "gl", "ko", "md", "path", "rn"]
+    assert entries["K00873"].startswith("ENTRY       K00873")
+    assert entries["K00873"].endswith("///\n")
+
+
+def test_rows_match_previous_parser():
+    entries = read_entries()
+    with open(ROWS_FP) as f:
+        expected = json.load(f)
+
+    for data_type in ["ko", "rn", "path", "md", "cpd", "gl"]:
+        assert process_rows(entries, data_type) == expected[data_type], data_type
+    # Reactions which are not expanded have no links to pathways
+    assert process_rows(entries, "rn", expand=False) == expected["rn_no_expand"]
+
+
+def test_parse_ortholog():
+    entries = read_entries()
+    ortholog = kegg_flatfile.parse_entry("ko", "K00873", entries["K00873"])
+    assert ortholog.name == "PK, pyk"
+    assert ortholog.definition == "pyruvate kinase [EC:2.7.1.40]"
+    assert sorted(ortholog.reactions) == ["R00200", "R00430", "R01138", "R01858", "R02320"]
+
+    # Orthologs without any reactions
+    assert kegg_flatfile.parse_entry("ko", "K12345", entries["K12345"]).reactions == ()
+
+
+def test_parse_reaction():
+    entries = read_entries()
+    reaction = kegg_flatfile.parse_entry("rn", "R00004", entries["R00004"])
+    assert reaction.equation == "C00013 + C00001 <=> 2 C00009"
+    assert reaction.direction == 2
+    assert reaction.compounds == (("C00013", "L", "1"), ("C00001", "L", "1"), ("C00009", "R", "2"))
+    assert reaction.pathways == ("rn00190", )
+
+    assert kegg_flatfile.parse_entry("rn", "R01786", entries["R01786"]).direction == 0
+    assert kegg_flatfile.parse_entry("rn", "R00754", entries["R00754"]).enzyme == "1.1.1.1         1.1.1.71"
+
+    # Glycans are compounds of reactions too
+    reaction = kegg_flatfile.parse_entry("rn", "R05979", entries["R05979"])
+    assert reaction.direction == 1
+    assert ("G00001", "R", "1") in reaction.compounds
+
+    # Reactions without an equation have no direction
+    reaction = kegg_flatfile.parse_entry("rn", "R09999", entries["R09999"])
+    assert reaction.direction is None
+    assert reaction.compounds == ()
+
+
+def test_parse_pathway_and_module():
+    entries = read_entries()
+    pathway = kegg_flatfile.parse_entry("path", "rn00010", entries["rn00010"])
+    assert pathway.name == "Glycolysis / Gluconeogenesis"
+    assert pathway.pathway_class == "Metabolism; Carbohydrate metabolism"
+    # Only the first line of the description is kept
+    assert pathway.description.startswith("Glycolysis is the process")
+    assert pathway.reactions == ("R00200", "R00754", "R01786", "R01070")
+    assert pathway.modules == ("M00001", "M00002", "M00307")
+    assert pathway.compounds == ("C00022", "C00024", "C00031", "C00074")
+
+    module = kegg_flatfile.parse_entry("md", "M00001", entries["M00001"])
+    assert module.module_class.startswith("Pathway modules")
+    assert module.reactions == ("R01786", "R02189", "R02740", "R00200")
+    assert module.compounds[0] == "C00267"
+
+
+def test_parse_compound():
+    entries = read_entries()
+    compound = kegg_flatfile.parse_entry("cpd", "C00022", entries["C00022"])
+    assert compound.formula == "C3H4O3"
+    assert compound.names == ("Pyruvate", "Pyruvic acid", "2-Oxopropanoate", "2-Oxopropanoic acid")
+
+    glycan = kegg_flatfile.parse_entry("gl", "G00001", entries["G00001"])
+    assert glycan.formula == "(GlcNAc)1 (PP-Dol)1"
+
+    # Entries which are missing from KEGG are parsed as empty records
+    assert kegg_flatfile.parse_entry("cpd", "C00060", None) == kegg_flatfile.Compound("C00060", "", ())
+
+
+def test_benchmark(capsys):
+    entries = kegg_flatfile.read_flatfile_entries(ENTRIES_FP)
+    assert len(entries) == 15
+    kegg_flatfile.benchmark(entries, repeats=1)
+    assert capsys.readouterr().out.startswith("Parsed 15 entries")
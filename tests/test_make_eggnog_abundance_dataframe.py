@@ -0,0 +1,110 @@
+"""Tests of building and updating the table of eggNOG abundances."""
+
+import json
+
+import pytest
+
+import make_eggnog_abundance_dataframe as make_df
+import storage
+
+ANNOT = {"K00001": {"g1", "g2"}, "K00002": {"g3"}}
+
+
+def write_sample(tmp_path, sample_name, depths):
+    fp = str(tmp_path / (sample_name + ".json"))
+    with open(fp, "w") as f:
+        json.dump({"results": [{"id": gene_id, "depth": depth} for gene_id, depth in depths.items()]}, f)
+    return fp
+
+
+def build(eggnog_annot, sample_sheet):
+    """Table and manifest made from scratch, as by make_eggnog_abundance_dataframe()."""
+    manifest = {
+        "annotation_index": make_df.hash_eggnog_annot(eggnog_annot),
+        "annotation_digests": make_df.digest_eggnog_annot(eggnog_annot),
+        "samples": {
+            sample_name: {"path": fp, "etag": storage.get_etag(fp)}
+            for sample_name, fp in sample_sheet.items()
+        },
+    }
+    df = make_df.read_eggnog_proportion_df(eggnog_annot, sample_sheet, "results", "depth", "id")
+    return df, manifest
+
+
+def update(existing_df, manifest, eggnog_annot, sample_sheet):
+    return make_df.update_eggnog_proportion_df(
+        existing_df,
+        manifest,
+        eggnog_annot,
+        make_df.hash_eggnog_annot(eggnog_annot),
+        make_df.digest_eggnog_annot(eggnog_annot),
+        sample_sheet,
+        {sample_name: storage.get_etag(fp) for sample_name, fp in sample_sheet.items()},
+        "results",
+        "depth",
+        "id"
+    )
+
+
+@pytest.fixture
+def read_samples(monkeypatch):
+    """Record the name of every sample which is read."""
+    pytest.importorskip("pandas")
+    read = []
+    read_sample_proportions = make_df.read_sample_proportions
+
+    def record(eggnog_annot, sample_name, *args):
+        read.append(sample_name)
+        return read_sample_proportions(eggnog_annot, sample_name, *args)
+
+    monkeypatch.setattr(make_df, "read_sample_proportions", record)
+    return read
+
+
+def test_added_annotations_keep_existing_samples(tmp_path, read_samples):
+    sample_sheet = {"s1": write_sample(tmp_path, "s1", {"g1": 1, "g2": 1, "g3": 2})}
+    existing_df, manifest = build(ANNOT, sample_sheet)
+
+    # A new annotation file adds the genes of a new sample
+    eggnog_annot = dict(ANNOT, K00003={"g4"})
+    sample_sheet["s2"] = write_sample(tmp_path, "s2", {"g1": 1, "g4": 3})
+    del read_samples[:]
+    df = update(existing_df, manifest, eggnog_annot, sample_sheet)
+
+    assert read_samples == ["s2"]
+    assert list(df.columns) == ["s1", "s2"]
+    assert df.loc["K00001", "s1"] == pytest.approx(0.5)
+    assert df.loc["K00003", "s1"] == 0
+    assert df.loc["K00003", "s2"] == pytest.approx(0.75)
+
+
+def test_changed_annotations_process_every_sample(tmp_path, read_samples):
+    sample_sheet = {"s1": write_sample(tmp_path, "s1", {"g1": 1, "g2": 1, "g3": 2})}
+    existing_df, manifest = build(ANNOT, sample_sheet)
+
+    # A gene which moves to another annotation changes the existing samples
+    eggnog_annot = {"K00001": {"g1"}, "K00002": {"g2", "g3"}}
+    del read_samples[:]
+    df = update(existing_df, manifest, eggnog_annot, sample_sheet)
+
+    assert read_samples == ["s1"]
+    assert df.loc["K00002", "s1"] == pytest.approx(0.75)
+
+    # As do manifests from earlier versions, which do not record each annotation
+    del manifest["annotation_digests"]
+    del read_samples[:]
+    update(existing_df, manifest, dict(ANNOT, K00003={"g4"}), sample_sheet)
+    assert read_samples == ["s1"]
+
+
+def test_abundance_matrix_with_duplicated_genes():
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame(
+        {"s1": [1.0, 1.0, 2.0, 4.0], "s2": [0.0, 2.0, 2.0, None]},
+        index=["g1", "g2", "g3", "g1"]
+    )
+
+    eggnog_df = make_df.calculate_proportions_by_eggnog_annot(df, ANNOT)
+    assert eggnog_df.loc["K00001", "s1"] == pytest.approx(0.75)
+    assert eggnog_df.loc["K00002", "s1"] == pytest.approx(0.25)
+    assert eggnog_df.loc["K00001", "s2"] == pytest.approx(0.5)
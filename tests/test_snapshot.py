@@ -0,0 +1,72 @@
+"""Tests of exporting a KEGG database with --export-dir and rebuilding it offline with --snapshot."""
+
+import sqlite3
+from collections import Counter
+
+import pytest
+
+import get_kegg_reaction_metadata
+from kegg_server import start_server, write_input_tsv
+
+KOS = ["K00001", "K00844,K00873", "K12345"]
+
+
+def read_tables(db_path):
+    """Sorted rows of every KEGG table in a database."""
+    conn = sqlite3.connect(db_path)
+    tables = {
+        table: sorted(conn.execute("SELECT {} FROM {};".format(columns, table)).fetchall(), key=repr)
+        for table, columns in get_kegg_reaction_metadata.MIGRATE_V1
+    }
+    conn.close()
+    return tables
+
+
+def build_and_rebuild(tmp_path, **kwargs):
+    """Build a database from the local server and export it, then rebuild it from the export."""
+    pytest.importorskip("pyarrow")
+    requested = Counter()
+    server = start_server(requested)
+    input_tsv = str(tmp_path / "annotations.tsv")
+    write_input_tsv(input_tsv, KOS)
+    try:
+        get_kegg_reaction_metadata.get_kegg_reaction_metadata(
+            input_tsv=input_tsv,
+            output_db=str(tmp_path / "built.db"),
+            threads=2,
+            requests_per_second=1000,
+            kegg_url="http://127.0.0.1:{}".format(server.server_port),
+            export_dir=str(tmp_path / "export"),
+            **kwargs
+        )
+        requested.clear()
+        get_kegg_reaction_metadata.get_kegg_reaction_metadata(
+            input_tsv=input_tsv,
+            output_db=str(tmp_path / "rebuilt.db"),
+            cache_db=str(tmp_path / "rebuilt_cache.db"),
+            snapshot=str(tmp_path / "export"),
+            kegg_url="http://127.0.0.1:{}".format(server.server_port)
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Nothing is fetched from KEGG to rebuild the database
+    assert len(requested) == 0, requested
+    return read_tables(str(tmp_path / "built.db")), read_tables(str(tmp_path / "rebuilt.db"))
+
+
+def test_snapshot_of_bulk_links_export(tmp_path):
+    built, rebuilt = build_and_rebuild(tmp_path, bulk_links=True, cache_db=str(tmp_path / "cache.db"))
+    assert len(built["ortholog"]) == len(KOS) + 1
+    assert rebuilt == built
+
+    conn = sqlite3.connect(str(tmp_path / "rebuilt.db"))
+    assert conn.execute("SELECT COUNT(*) FROM crawl_queue WHERE state != 'fetched';").fetchone() == (0, )
+    conn.close()
+
+
+def test_snapshot_of_export_without_cache(tmp_path):
+    built, rebuilt = build_and_rebuild(tmp_path)
+    assert len(built["reaction"]) > 0
+    assert rebuilt == built
@@ -0,0 +1,54 @@
+"""Tests of reading and writing files on S3, against a mocked S3."""
+
+import os
+import threading
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        # Clients made outside of the mock are not used
+        monkeypatch.setattr(storage, "s3_local", threading.local())
+        storage.get_s3_client().create_bucket(Bucket="bucket")
+        yield "s3://bucket"
+
+
+def test_ranged_reads_share_threads(s3_bucket, monkeypatch):
+    monkeypatch.setattr(storage, "S3_RANGE_SIZE", 1 << 20)
+    data = os.urandom(5 * (1 << 20) + 1)
+    with storage.open_write(s3_bucket + "/big.bin") as f:
+        f.write(data)
+
+    assert storage.read_bytes(s3_bucket + "/big.bin") == data
+    pool = storage.get_range_pool()
+    n_threads = threading.active_count()
+
+    # Later reads, including concurrent ones, reuse the same threads
+    results = []
+    readers = [
+        threading.Thread(target=lambda: results.append(storage.read_bytes(s3_bucket + "/big.bin")))
+        for _ in range(3)
+    ]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    assert results == [data] * 3
+    assert storage.get_range_pool() is pool
+    assert threading.active_count() == n_threads
+
+
+def test_gzip_round_trip(s3_bucket):
+    text = "".join(["line\t{}\n".format(ix) for ix in range(10000)])
+    with storage.open_write(s3_bucket + "/table.tsv.gz") as f:
+        f.write(text.encode("utf-8"))
+    with storage.open_read(s3_bucket + "/table.tsv.gz", "rt") as f:
+        assert f.read() == text